@@ -1,47 +1,187 @@
-import matplotlib.pyplot as plt
+import os
+from functools import lru_cache
 import numpy as np
+from instrumentation import timed
 
 # this is the data we got from testing the helical resonator. there is more info in the notebook
 # I use the data to model the laser beam in the module beam_class
-txtfile = open("7-28-2021_helicalTest_EOM_power.txt", "r")
-txtdata = []
-
-skip = 0
-for i in txtfile:
-    plaintext = i.strip()
-    plainvalues = plaintext.split()
-    for k in range(len(plainvalues)):
-        try:
-            plainvalues[k] = float(plainvalues[k])
-        except ValueError:
-            skip = 1
-    if skip == 0:
-        txtdata.append(plainvalues)
-    else:
-        skip = 0
-
-txtfile.close()
-
-data = np.array(txtdata)
-dBm, main, side, second_ord, third_ord, v_ref = zip(*data)
-plot_vars = [dBm, main, side, second_ord, third_ord, v_ref]
-for i in range(len(plot_vars)):
-    plot_vars[i] = np.asarray(plot_vars[i])
-
-allpeaks = plot_vars[1] + 2 * (plot_vars[2] + plot_vars[3] + plot_vars[4])
+# the file is found next to this module (not in the working directory), and it is only read the first time the data
+# is needed, so importing this module does nothing
+data_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "7-28-2021_helicalTest_EOM_power.txt")
+
+
+@lru_cache(maxsize=None)
+def load_data(path=data_file):  # reads the resonator data, returns the list [plot_vars] and the array [allpeaks]
+    txtfile = open(path, "r")
+    txtdata = []
+
+    skip = 0
+    for i in txtfile:
+        plaintext = i.strip()
+        plainvalues = plaintext.split()
+        for k in range(len(plainvalues)):
+            try:
+                plainvalues[k] = float(plainvalues[k])
+            except ValueError:
+                skip = 1
+        if skip == 0:
+            txtdata.append(plainvalues)
+        else:
+            skip = 0
+
+    txtfile.close()
+
+    data = np.array(txtdata)
+    plot_vars = [np.asarray(i) for i in zip(*data)]  # dBm, main, side, second_ord, third_ord, v_ref
+    allpeaks = plot_vars[1] + 2 * (plot_vars[2] + plot_vars[3] + plot_vars[4])
+    return plot_vars, allpeaks
+
+
+# the side bands made by the EOM, built once from the resonator data. the measured peak strengths are turned into
+# ratio tables (peak / allpeaks) for the main peak and the first three orders, so they are not recalculated every
+# time. strengths can be found for an array of dBm values at once, by linear interpolation of the tables inside the
+# measured range (-25 to -9 dBm), or with a phase modulation model: the EOM puts a fraction J_n(beta)**2 of the power
+# in each side band of order n (J_n is a Bessel function), where the modulation index beta is proportional to the rf
+# voltage, beta = beta_1V * 10 ** (dBm / 20). beta_1V is fitted to the data, and the model works for any dBm and any
+# number of orders
+class SidebandModel:
+    def __init__(self, plot_vars, allpeaks):
+        self.dBm = np.asarray(plot_vars[0], dtype=float)
+        self.ratios = np.array([plot_vars[band] / allpeaks for band in (1, 2, 3, 4)])  # (order 0 to 3, len(dBm))
+        self._beta_1V = None
+
+    @property
+    def beta_1V(self):  # the modulation index at 0 dBm, only fitted the first time the Bessel model is needed
+        if self._beta_1V is None:
+            self._beta_1V = self.fit_bessel()
+        return self._beta_1V
+
+    def bessel_ratios(self, beta, orders):  # J_n(beta)**2 for each order, the last axis is the orders
+        from scipy.special import jv
+        return jv(np.asarray(orders), np.asarray(beta, dtype=float)[..., np.newaxis]) ** 2
+
+    def fit_bessel(self):  # fits beta_1V so the Bessel model matches the measured ratio tables
+        from scipy.optimize import minimize_scalar
+
+        def error(log_beta):
+            model = self.bessel_ratios(np.exp(log_beta) * 10 ** (self.dBm / 20), range(4))
+            model = model / (model[:, :1] + 2 * model[:, 1:].sum(axis=1, keepdims=True))  # normalized like allpeaks
+            return np.sum((model.T - self.ratios) ** 2)
+        fit = minimize_scalar(error, bounds=(-5, 5), method='bounded', options={'xatol': 10 ** -12})
+        return float(np.exp(fit.x))
+
+    def beta(self, dBm):  # the modulation index for the rf power dBm
+        return self.beta_1V * 10 ** (np.asarray(dBm, dtype=float) / 20)
+
+    @timed('sideband_model.strengths')
+    def strengths(self, dBm, orders=(0, 1, 2), method='auto'):
+        # the fraction of the power in one side band of each order (0 is the main peak), for every value in dBm.
+        # the output has the shape dBm.shape + (len(orders),)
+        # method 'interp' uses the measured tables (orders 0 to 3, -25 to -9 dBm), 'bessel' uses the fitted phase
+        # modulation model, and 'auto' uses the tables where they exist and the model everywhere else. past the ends
+        # of the tables the model is scaled to match them at the end (see _combined), so there is no step at -25 or -9
+        # dBm, and if orders above 3 are used, every order up to the highest one is normalized together so the total
+        # power (main peak + 2 * every side band order) is 1. the tables have 0 where a peak was too small to measure
+        # (orders 2 and 3 at low power). with orders above 3 those points are filled in from the model, so every order
+        # past the measured ones comes from the model and the orders do not go 0 then up again. with orders 0 to 3
+        # only, the tables are used as they are
+        return self._combined(dBm, orders, method)[0]
+
+    def slopes(self, dBm, orders=(0, 1, 2), method='auto'):
+        # the derivative of strengths with respect to dBm (per dB), with the same shape and methods as strengths.
+        # the tables are straight lines between the measured points, so there it is the slope of the piece dBm is on
+        # (the one to the right at a measured point). the Bessel model gives 2 J_n(beta) J_n'(beta) dbeta/ddBm.
+        # only the strengths are continuous at the ends of the tables: like at every measured point, the slope can
+        # jump there (from the slope of the last table piece to the slope of the scaled model)
+        return self._combined(dBm, orders, method)[1]
+
+    edge_fade = 3  # dB, how far past the ends of the tables the model is pulled towards the values at the ends
+
+    def _combined(self, dBm, orders, method):
+        # the strengths and slopes of every order from 0 to the highest one in orders, then the ones in orders.
+        # past an end of the tables (at edge), a measured order is the model times 1 + (r - 1) * exp(-|dBm - edge| /
+        # edge_fade), where r is the table value over the model value at the end: equal to the table at the end, the
+        # plain model far away, and never negative
+        from scipy.special import jv, jvp
+        dBm, orders, inside = self._check(dBm, orders, method)
+        n = np.arange(orders.max() + 1)
+        beta = self.beta(dBm)[..., np.newaxis]
+        out = jv(n, beta) ** 2
+        d_out = 2 * jv(n, beta) * jvp(n, beta) * beta * np.log(10) / 20
+        if method == 'bessel':
+            return out[..., orders], d_out[..., orders]
+
+        ratios = self.ratios
+        mixed = len(n) > len(ratios)  # orders past the tables are used too
+        if mixed:
+            ratios = np.where(ratios > 0, ratios, self.bessel_ratios(self.beta(self.dBm), range(len(ratios))).T)
+        n_table = min(len(n), len(ratios))
+        piece = np.clip(np.searchsorted(self.dBm, dBm, side='right') - 1, 0, len(self.dBm) - 2)
+        table_slopes = np.diff(ratios, axis=1) / np.diff(self.dBm)  # (order 0 to 3, pieces)
+        table = np.stack([np.interp(dBm, self.dBm, ratios[k]) for k in range(n_table)], axis=-1)
+        d_table = np.stack([table_slopes[k][piece] for k in range(n_table)], axis=-1)
+
+        below = (dBm < self.dBm[0])[..., np.newaxis]
+        ends = self.bessel_ratios(self.beta(self.dBm[[0, -1]]), range(n_table))  # the model at both ends
+        r = np.where(below, ratios[:n_table, 0] / ends[0], ratios[:n_table, -1] / ends[1])
+        distance = np.where(below[..., 0], self.dBm[0] - dBm, dBm - self.dBm[-1])[..., np.newaxis]
+        fade = np.exp(-distance / self.edge_fade)
+        scale = 1 + (r - 1) * fade
+        d_scale = (r - 1) * fade * np.where(below, 1, -1) / self.edge_fade
+        anchored = out[..., :n_table] * scale
+        d_anchored = d_out[..., :n_table] * scale + out[..., :n_table] * d_scale
+        out[..., :n_table] = np.where(inside[..., np.newaxis], table, anchored)
+        d_out[..., :n_table] = np.where(inside[..., np.newaxis], d_table, d_anchored)
+
+        if mixed:  # the tables only add up to 1 with orders 0 to 3
+            total = out[..., :1] + 2 * out[..., 1:].sum(axis=-1, keepdims=True)
+            d_total = d_out[..., :1] + 2 * d_out[..., 1:].sum(axis=-1, keepdims=True)
+            d_out = d_out / total - out * d_total / total ** 2
+            out = out / total
+        return out[..., orders], d_out[..., orders]
+
+    def _check(self, dBm, orders, method):  # the arrays used by strengths and slopes, and which dBm are measured
+        dBm = np.asarray(dBm, dtype=float)
+        orders = np.abs(np.asarray(orders, dtype=int))
+        inside = (dBm >= self.dBm[0]) & (dBm <= self.dBm[-1])
+        measured = orders < len(self.ratios)
+        if method == 'interp' and not (np.all(inside) and np.all(measured)):
+            raise ValueError('the resonator data only covers orders 0 to ' + str(len(self.ratios) - 1) + ' and ' +
+                             str(self.dBm[0]) + ' to ' + str(self.dBm[-1]) + ' dBm, use method bessel or auto')
+        if method not in ('auto', 'interp', 'bessel'):
+            raise ValueError('unknown side band method ' + repr(method) + ', use auto, interp or bessel')
+        return dBm, orders, inside
+
+
+@lru_cache(maxsize=None)
+def sideband_model(path=data_file):  # the SidebandModel of the resonator data, built the first time it is needed
+    return SidebandModel(*load_data(path))
 
 
 # for a given dBm of the rf source, this function outputs the power in each side band divided by the total power.
-# it is based on the data. I use this in the beam_class module
+# it is based on the data. I use this in the beam_class module. band is 1 for the main peak, 2 for the first order side
+# band, 3 for the second order and 4 for the third. outside of the measured range it uses the Bessel model
+@timed('band_strength')
 def band_strength(in_dBm, band):
-    l_index = np.where(plot_vars[0] <= in_dBm)[0][-1]
-    l_dist = in_dBm - plot_vars[0][l_index]
-    t_dist = plot_vars[0][l_index + 1] - plot_vars[0][l_index]
-    amp_dist = (plot_vars[band] / allpeaks)[l_index + 1] - (plot_vars[band] / allpeaks)[l_index]
-    return (plot_vars[band] / allpeaks)[l_index] + amp_dist * l_dist / t_dist
+    return sideband_model().strengths(in_dBm, [band - 1])[..., 0]
+
+
+def __getattr__(name):  # the old module level variables, the data file is read only when someone uses them
+    names = ['dBm', 'main', 'side', 'second_ord', 'third_ord', 'v_ref']
+    if name == 'plot_vars':
+        return load_data()[0]
+    if name == 'allpeaks':
+        return load_data()[1]
+    if name in names:
+        return load_data()[0][names.index(name)]
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    plot_vars, allpeaks = load_data()
+    dBm = plot_vars[0]
+
     plt.plot(plot_vars[0], plot_vars[1], label='Main', marker='o')
     plt.plot(plot_vars[0], plot_vars[2], label='Side Band', marker='o')
     plt.plot(plot_vars[0], plot_vars[3], label='Second Order', marker='o')
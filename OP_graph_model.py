@@ -1,83 +1,289 @@
+from functools import lru_cache
 import numpy as np
 import beam_spectrum as spec
 import beam_class
+import instrumentation
+import rate_cache
 import state_data
-from scipy.integrate import solve_ivp
-import matplotlib.pyplot as plt
+from state_registry import registry
+
+# like beam_spectrum, nothing is calculated when this module is imported. solve_pumping(config) solves the rate
+# equations for the laser settings in config (a beam_spectrum.LaserConfig) the first time it is asked for
 
 A21 = beam_class.A21
-gr = spec.rates  # this is the average rate of photon scattering for each transition when excited by our laser system
+# gr is the average rate of photon scattering for each transition when excited by our laser system. it comes from
+# spec.compute_rates(config)[0] and is passed to state_rates. spec.rates gives it for the default settings
 
 # see https://demonstrations.wolfram.com/TransitionStrengthsOfAlkaliMetalAtoms/
 emit_str = state_data.emit_str
 
-st = ['|2,-2)', '|2,-1)', '|2, 0)', '|2, 1)', '|2, 2)', '|1,-1)', '|1, 0)', '|1, 1)',
-      'e|2,-2)', 'e|2,-1)', 'e|2, 0)', 'e|2, 1)', 'e|2, 2)', 'e|1,-1)', 'e|1, 0)', 'e|1, 1)']
+st = registry.labels  # '|2,-2)', '|2,-1)', '|2, 0)', '|2, 1)', '|2, 2)', '|1,-1)', '|1, 0)', '|1, 1)', 'e|2,-2)', ...
 # the order of the states in the variable [v] below follows the above variable [st]
+st_index = registry.index  # the position of each state in [st], instead of st.index
 
 
 # This is the differential equation
-def state_rates(s, v):  # returns the derivative of each population in each state for given populations [v]
+def state_rates(s, v, gr=None):  # returns the derivative of each population in each state for given populations [v]
+    # {gr} is the rates from beam_spectrum.compute_rates, the default laser settings if it is not given
+    instrumentation.count('state_rates')
+    if gr is None:
+        gr = spec.compute_rates()[0]
     dv = [0] * 16  # [dv] is the same size as [v]
     # for each transition from a ground state to an excited state, the rate per atom is stored in the dictionary {gr}
     for k, m in gr.items():
         for n, o in m.items():
-            dv[st.index(k)] = dv[st.index(k)] - o * v[st.index(k)]
-            dv[st.index(n)] = dv[st.index(n)] + o * v[st.index(k)]
+            dv[st_index[k]] = dv[st_index[k]] - o * v[st_index[k]]
+            dv[st_index[n]] = dv[st_index[n]] + o * v[st_index[k]]
     # for each transition from an excited state to a ground state, the rate per atom is a fraction of A21
     # the fraction is stored in the dictionary {emit_str} (stands for emission strength)
     for p, q in emit_str.items():
         for r, s in q.items():
-            dv[st.index(p)] = dv[st.index(p)] - A21 * s * v[st.index(p)]
-            dv[st.index(r)] = dv[st.index(r)] + A21 * s * v[st.index(p)]
+            dv[st_index[p]] = dv[st_index[p]] - A21 * s * v[st_index[p]]
+            dv[st_index[r]] = dv[st_index[r]] + A21 * s * v[st_index[p]]
     # the rate for a transition leaving a state is always proportional to the population in the state itself
     # the rate for a transition going into a state is proportional to the population of a different state
     return dv
 
 
-# this solves the differential equation above for the initial condition: 100% of atoms in ground [2, -2)
-OP_model_input = solve_ivp(state_rates, (0, 5 * 10 ** -5), [100, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                           t_eval=np.arange(0, 5 * 10 ** -5 + 10 ** -6, 10 ** -6))
-
-for q in range(8):
-    plt.plot(OP_model_input.t, OP_model_input.y.T[:, q:q + 1], label=st[q])
-plt.title('Percent of atoms in each ground state vs time')
-plt.xlabel('Time (s)')
-plt.ylabel('Percent')
-plt.legend()
-plt.show()
-
-for q in range(8, 16):
-    plt.plot(OP_model_input.t, OP_model_input.y.T[:, q:q + 1], label=st[q])
-plt.title('Percent of atoms in each excited state vs time')
-plt.xlabel('Time (s)')
-plt.ylabel('Percent')
-plt.legend()
-plt.show()
-
-total = OP_model_input.y.T[:, 15:16]
-for i in range(15):
-    total = total + OP_model_input.y.T[:, i:i + 1]
-
-plt.plot(OP_model_input.t, total, label='total')
-plt.title('Total percent of atoms vs time')
-plt.xlabel('Time (s)')
-plt.ylabel('Percent')
-plt.show()
-
-# this solves the differential equation above for the initial condition: 100% of atoms in ground [2, 2)
-OP_model_ring = solve_ivp(state_rates, (0, 5 * 10 ** -5), [0, 0, 0, 0, 100, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                          t_eval=np.arange(0, 5 * 10 ** -5 + 10 ** -6, 10 ** -6))
-
-plt.plot(OP_model_ring.t, OP_model_ring.y.T)
-plt.title('After a cycle in the ring, percent of atoms in each ground state vs time')
-plt.xlabel('Time (s)')
-plt.ylabel('Percent')
-plt.show()
-
-print('#########################################################################################')
-print('percent in |2, 2) after initial input: ', OP_model_input.y.T[:, 4:5][-1])
-print('percent in |2, 2) after a cycle in the ring: ', OP_model_ring.y.T[:, 4:5][-1])
-print('percent in |2, 1) and |2, 2) after a cycle in the ring: ', OP_model_ring.y.T[:, 3:4][-1] +
-      OP_model_ring.y.T[:, 4:5][-1])
-print('number of cycles until half atoms lost: ', np.log(1 / 2) / np.log(OP_model_ring.y.T[:, 4:5][-1] / 100))
+# the rate equations are linear and do not change with time, dv/dt = M @ v, where M is a 16x16 matrix (the generator)
+# that only depends on the rates. so instead of calling state_rates thousands of times in solve_ivp, I build M once
+# and the populations at any time are exactly v(t) = expm(M * t) @ v(0)
+
+
+def absorption_matrix(gr):  # the part of the generator M from the laser, for the rates in {gr}
+    return registry.absorption_matrix([gr[g_state][e_state] for g_state, e_state in registry.transitions])
+
+
+def emission_matrix():  # the part of the generator M from spontaneous emission
+    return registry.emission_matrix(A21)
+
+
+def rate_matrix(gr):  # the generator M, so that state_rates(s, v, gr) is the same as rate_matrix(gr) @ v
+    return absorption_matrix(gr) + emission_matrix()
+
+
+@instrumentation.timed('propagate')
+def propagate(M, v0, times, method='eig'):
+    # returns the populations at each time in [times] starting from [v0] at time 0
+    # M can be one generator (16x16) or a stack of them (shape (..., 16, 16)), and v0 can be one population vector or
+    # a stack of them (shape (..., 16)). the stacks are broadcast against each other like numpy arrays, so the output
+    # has the shape (batch..., 16, len(times)), e.g. (16, len(times)) for one trajectory, or (n_configs, 8, 16,
+    # len(times)) for M of shape (n_configs, 1, 16, 16) and v0 of shape (8, 16). everything is done with stacked numpy
+    # calls, there is no python loop over the trajectories
+    # 'eig' uses the eigendecomposition M = V diag(w) V^-1, so v(t) = V diag(exp(w t)) V^-1 v0 for every time at once.
+    # if V is too badly conditioned for that to be accurate, or method is 'expm', it uses scipy.linalg.expm instead
+    times = np.asarray(times, dtype=float)
+    M = np.asarray(M, dtype=float)
+    v0 = np.asarray(v0, dtype=float)
+    batch = np.broadcast_shapes(M.shape[:-2], v0.shape[:-1])
+    if method != 'eig':
+        return _propagate_expm(M, v0, times, batch)
+    w, V, c, bad = eig_solution(M, v0)
+    v0_batch = np.broadcast_to(v0, batch + v0.shape[-1:])
+    y = eig_populations(w, V, c, times)
+    bad = np.broadcast_to(bad, batch)
+    if np.any(bad):  # only the badly conditioned trajectories are done again with expm
+        M_bad = np.broadcast_to(M, batch + M.shape[-2:])[bad]
+        v0_bad = v0_batch[bad]
+        y[bad] = _propagate_expm(M_bad, v0_bad, times, v0_bad.shape[:-1])
+    return y
+
+
+def eig_solution(M, v0):
+    # the eigendecomposition part of propagate: the eigenvalues w and eigenvectors V of M and the coefficients c of v0,
+    # so v(t) = Re(V @ (c * exp(w t))) (see eig_populations), and which of them (bad) are too badly conditioned for it
+    M = np.asarray(M, dtype=float)
+    v0 = np.asarray(v0, dtype=float)
+    batch = np.broadcast_shapes(M.shape[:-2], v0.shape[:-1])
+    w, V = np.linalg.eig(M)
+    bad = np.linalg.cond(V, 1) >= 10 ** 8  # inf if V is singular
+    V = np.where(bad[..., np.newaxis, np.newaxis], np.eye(M.shape[-1]), V)  # so solve works, redone with expm anyway
+    v0_batch = np.broadcast_to(v0, batch + v0.shape[-1:])
+    c = np.linalg.solve(V, v0_batch[..., np.newaxis].astype(complex))[..., 0]
+    return w, V, c, bad
+
+
+def eig_populations(w, V, c, times):  # the populations at [times] from eig_solution, shape (batch..., 16, len(times))
+    return np.real(V @ (c[..., np.newaxis] * np.exp(w[..., np.newaxis] * np.asarray(times, dtype=float))))
+
+
+def _propagate_expm(M, v0, times, batch):
+    # steps from one time to the next with v(t + dt) = expm(M * dt) @ v(t). the step matrix is only calculated once
+    # for each different dt, so an evenly spaced [times] needs one (stacked) expm
+    from scipy.linalg import expm
+    steps = {}
+    v = np.broadcast_to(v0, batch + v0.shape[-1:])
+    if times[0] != 0:
+        v = (expm(times[0] * M) @ v[..., np.newaxis])[..., 0]
+    y = np.empty(batch + v0.shape[-1:] + times.shape)
+    y[..., 0] = v
+    for k in range(1, len(times)):
+        dt = float('%.12g' % (times[k] - times[k - 1]))
+        if dt not in steps:
+            steps[dt] = expm(dt * M)
+        v = (steps[dt] @ v[..., np.newaxis])[..., 0]
+        y[..., k] = v
+    return y
+
+
+@instrumentation.timed('propagate_sparse')
+def propagate_sparse(M, v0, times):
+    # like propagate for one sparse generator (a scipy.sparse matrix, see level_structure), with
+    # scipy.sparse.linalg.expm_multiply. it only uses products M @ v, so the dense matrix exponential is never made.
+    # evenly spaced times are done in one call, others one step at a time. returns shape (n_states, len(times))
+    from scipy.sparse.linalg import expm_multiply
+    times = np.asarray(times, dtype=float)
+    v = np.asarray(v0, dtype=float)
+    steps = np.diff(times)
+    if len(times) > 1 and np.allclose(steps, steps[0], rtol=10 ** -9, atol=0):
+        return expm_multiply(M, v, start=times[0], stop=times[-1], num=len(times), endpoint=True).T
+    y = np.empty(v.shape + times.shape)
+    for k in range(len(times)):
+        dt = times[k] - (times[k - 1] if k > 0 else 0)
+        if dt != 0:
+            v = expm_multiply(M * dt, v)
+        y[:, k] = v
+    return y
+
+
+def solve_rates(M, v0, times, method='eig'):
+    # solves dv/dt = M @ v and returns a result with .t and .y like solve_ivp, so it can be used in its place
+    # method can be 'eig' or 'expm' (exact, see propagate), or any solve_ivp method. M can also be a function of time
+    # M(t) for cases where the rates change with time. those always go to solve_ivp, with 'BDF' if method is 'eig' or
+    # 'expm', because the system is stiff (A21 is much faster than most of the pumping rates)
+    # M can also be a scipy.sparse matrix (or M(t) can return one): 'eig' and 'expm' then use propagate_sparse, and
+    # the stiff solvers of solve_ivp factorize the sparse jacobian with a sparse LU
+    from scipy.integrate import solve_ivp
+    from scipy.optimize import OptimizeResult
+    from scipy.sparse import issparse
+    times = np.asarray(times, dtype=float)
+    if issparse(M) and method in ('eig', 'expm'):
+        return OptimizeResult(t=times, y=propagate_sparse(M, v0, times), success=True, status=0,
+                              message='Exact solution of the linear rate equations.')
+    if not callable(M) and method in ('eig', 'expm'):
+        return OptimizeResult(t=times, y=propagate(M, v0, times, method), success=True, status=0,
+                              message='Exact solution of the linear rate equations.')
+    if not callable(M):
+        matrix = M
+
+        def M(t):
+            return matrix
+    if method in ('eig', 'expm'):
+        method = 'BDF'
+    with instrumentation.profile.stage('solve_ivp'):
+        result = solve_ivp(lambda t, v: M(t) @ v, (times[0], times[-1]), v0, method=instrumentation.solver(method),
+                           t_eval=times, jac=lambda t, v: M(t), rtol=10 ** -8, atol=10 ** -8)
+    instrumentation.record_solver(result)
+    return result
+
+
+t_end = 5 * 10 ** -5  # s, time for an atom at 20000 cm/s to cross the 1 cm beam
+t_eval = np.arange(0, t_end + 10 ** -6, 10 ** -6)  # the times the populations are saved at
+v_input = [100, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]  # 100% of atoms in ground [2, -2)
+v_ring = [0, 0, 0, 0, 100, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]  # 100% of atoms in ground [2, 2)
+
+
+@instrumentation.timed('generator')
+def _generator(config):  # kept in rate_cache with the rate tables, so do not change it in place
+    # the rates per second are the photons in 1 cm times 20000 cm/s, in the order of registry.transitions
+    return rate_cache.cached('generator', config, lambda: {
+        'generator': registry.absorption_matrix(spec.rate_table(config) * 20000) + emission_matrix()})['generator']
+
+
+def generator(config=spec.default_config):  # the generator M for the laser settings in config, built once per config
+    return _generator(config).copy()
+
+
+@lru_cache(maxsize=128)
+@instrumentation.timed('solve_pumping')
+def _solve_pumping(config, method):
+    if method == 'legacy':  # the original way, solve_ivp with its default RK45 calling state_rates
+        from scipy.integrate import solve_ivp
+        gr = spec.compute_rates(config)[0]
+        with instrumentation.profile.stage('solve_ivp'):
+            OP_model_input = solve_ivp(state_rates, (0, t_end), v_input, method=instrumentation.solver('RK45'),
+                                       t_eval=t_eval, args=(gr,))
+        with instrumentation.profile.stage('solve_ivp'):
+            OP_model_ring = solve_ivp(state_rates, (0, t_end), v_ring, method=instrumentation.solver('RK45'),
+                                      t_eval=t_eval, args=(gr,))
+        instrumentation.record_solver(OP_model_input)
+        instrumentation.record_solver(OP_model_ring)
+        return OP_model_input, OP_model_ring
+    M = _generator(config)
+    # this solves the differential equation above for the initial condition: 100% of atoms in ground [2, -2)
+    OP_model_input = solve_rates(M, v_input, t_eval, method)
+    # this solves the differential equation above for the initial condition: 100% of atoms in ground [2, 2)
+    OP_model_ring = solve_rates(M, v_ring, t_eval, method)
+    return OP_model_input, OP_model_ring
+
+
+def solve_pumping(config=spec.default_config, method='eig'):
+    # returns the results (OP_model_input, OP_model_ring) for the laser settings in config. they have .t and .y like
+    # the results of solve_ivp. method is passed to solve_rates, or 'legacy' for the old solve_ivp + state_rates way.
+    # the results are cached, so do not change them in place
+    return _solve_pumping(config, method)
+
+
+ground_starts = 100 * np.eye(len(st))[:8]  # 100% of the atoms in each of the 8 ground states, one row each
+
+
+def solve_batch(configs, v0s=ground_starts, times=t_eval, method='eig'):
+    # solves the rate equations for every laser config in [configs] (beam_spectrum.LaserConfigs) and every initial
+    # population vector in [v0s] (shape (n_initial, 16)) together. returns an array of shape
+    # (len(configs), n_initial, 16, len(times)). the default [v0s] starts from each ground state
+    Ms = np.stack([_generator(config) for config in configs])
+    return propagate(Ms[:, np.newaxis], np.asarray(v0s, dtype=float)[np.newaxis], times, method)
+
+
+def __getattr__(name):  # the old module level results, calculated only when someone uses them
+    if name == 'gr':
+        return spec.compute_rates()[0]
+    if name == 'OP_model_input':
+        return solve_pumping()[0]
+    if name == 'OP_model_ring':
+        return solve_pumping()[1]
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    OP_model_input, OP_model_ring = solve_pumping()
+
+    for q in range(8):
+        plt.plot(OP_model_input.t, OP_model_input.y.T[:, q:q + 1], label=st[q])
+    plt.title('Percent of atoms in each ground state vs time')
+    plt.xlabel('Time (s)')
+    plt.ylabel('Percent')
+    plt.legend()
+    plt.show()
+
+    for q in range(8, 16):
+        plt.plot(OP_model_input.t, OP_model_input.y.T[:, q:q + 1], label=st[q])
+    plt.title('Percent of atoms in each excited state vs time')
+    plt.xlabel('Time (s)')
+    plt.ylabel('Percent')
+    plt.legend()
+    plt.show()
+
+    total = OP_model_input.y.T[:, 15:16]
+    for i in range(15):
+        total = total + OP_model_input.y.T[:, i:i + 1]
+
+    plt.plot(OP_model_input.t, total, label='total')
+    plt.title('Total percent of atoms vs time')
+    plt.xlabel('Time (s)')
+    plt.ylabel('Percent')
+    plt.show()
+
+    plt.plot(OP_model_ring.t, OP_model_ring.y.T)
+    plt.title('After a cycle in the ring, percent of atoms in each ground state vs time')
+    plt.xlabel('Time (s)')
+    plt.ylabel('Percent')
+    plt.show()
+
+    print('#########################################################################################')
+    print('percent in |2, 2) after initial input: ', OP_model_input.y.T[:, 4:5][-1])
+    print('percent in |2, 2) after a cycle in the ring: ', OP_model_ring.y.T[:, 4:5][-1])
+    print('percent in |2, 1) and |2, 2) after a cycle in the ring: ', OP_model_ring.y.T[:, 3:4][-1] +
+          OP_model_ring.y.T[:, 4:5][-1])
+    print('number of cycles until half atoms lost: ', np.log(1 / 2) / np.log(OP_model_ring.y.T[:, 4:5][-1] / 100))
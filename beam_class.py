@@ -1,7 +1,7 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import Graphing_txt_resonator as Mod
 band_strength = Mod.band_strength
+sideband_model = Mod.sideband_model
 
 # this module defines the class for the laser modulation
 
@@ -11,6 +11,7 @@ gamma = 5.9 * 10 ** 6  # Hz, rate of spontaneous emission
 A21 = 3.7 * 10 ** 7  # Hz, Einstein A Coefficient for our lithium transitions
 res_cross_sect = 2.1433 * 10 ** -13  # m ** 2, resonant cross section
 h_bar = 1.055 * 10 ** -34  # J * s, reduced planck's constant
+cutoff = 100 * 10 ** 6  # Hz, a Band does not excite transitions further away than this
 ##########################################################################################################
 
 
@@ -24,7 +25,7 @@ class Band:
     def cross_sect(self, freq_0):  # does not take cross section relative strength into account. that happens later
         # freq_0 is the frequency of any transition, while self.freq is the frequency of the Band which does not change
         # if you want a laser with a different frequency you need to define a new Band or Beam
-        if np.abs(freq_0 - self.freq) > 100 * 10 ** 6:
+        if np.abs(freq_0 - self.freq) > cutoff:
             return 0
         else:
             delta_omega = (self.freq - freq_0)
@@ -38,22 +39,30 @@ class Band:
         else:
             return rate3
 
+    def transition_rates(self, freqs):  # vectorized version of transition_rate, see the Spectrum class below
+        return Spectrum.from_bands(self).transition_rates(freqs)
+
+    def bands(self):  # every class has this method, it gives the list of Bands the object is made of
+        return [self]
+
     def plot(self, main_freq):  # plots a line showing the frequency of the Band relative to main_freq
+        import matplotlib.pyplot as plt  # only imported when plotting, so the calculations do not need matplotlib
         plt.plot([self.freq - main_freq, self.freq - main_freq], [self.power, 0], 'k')
 
 
 # the middle level is the 800MHz modulation, which splits the main Beam into three smaller bands
-# each of these Band800s will be split into five smaller Bands based on the dBm applied to the resonator + EOM
+# each of these Band800s will be split into five smaller Bands (2 * n_orders + 1) based on the dBm applied to the
+# resonator + EOM
 class Band800:
-    def __init__(self, power, freq, dBm80):
+    def __init__(self, power, freq, dBm80, n_orders=2):
+        # n_orders is the number of side band orders on each side (the measured data goes up to 3, the Bessel model
+        # of Graphing_txt_resonator is used for higher orders)
         self.power = power
         self.freq = freq
+        strengths = sideband_model().strengths(dBm80, range(n_orders + 1))  # all orders in one call
         self.spectrum1 = []
-        self.spectrum1.append(Band(power * band_strength(dBm80, 3), freq - 160 * 10 ** 6))
-        self.spectrum1.append(Band(power * band_strength(dBm80, 2), freq - 80 * 10 ** 6))
-        self.spectrum1.append(Band(power * band_strength(dBm80, 1), freq))
-        self.spectrum1.append(Band(power * band_strength(dBm80, 2), freq + 80 * 10 ** 6))
-        self.spectrum1.append(Band(power * band_strength(dBm80, 3), freq + 160 * 10 ** 6))
+        for order in range(-n_orders, n_orders + 1):
+            self.spectrum1.append(Band(power * strengths[abs(order)], freq + order * 80 * 10 ** 6))
 
     def transition_rate(self, freq_0):
         rate1 = 0
@@ -61,6 +70,12 @@ class Band800:
             rate1 = rate1 + i.transition_rate(freq_0)
         return rate1
 
+    def transition_rates(self, freqs):
+        return Spectrum.from_bands(self).transition_rates(freqs)
+
+    def bands(self):
+        return list(self.spectrum1)
+
     def plot(self, main_freq):
         for i in self.spectrum1:
             i.plot(main_freq)
@@ -69,13 +84,13 @@ class Band800:
 # the highest level is the Beam. this is the laser before any modulation (not including the lone 201 MHz band created
 # by the AOM - that one is defined as a separate Band)
 class Beam:
-    def __init__(self, power, freq, mod800, dBm80):
+    def __init__(self, power, freq, mod800, dBm80, n_orders=2):
         self.power = power
         self.freq = freq
         self.spectrum0 = []
-        self.spectrum0.append(Band800(self.power * mod800, freq - 800 * 10 ** 6, dBm80))
-        self.spectrum0.append(Band800(self.power * (1 - mod800 * 2), freq, dBm80))
-        self.spectrum0.append(Band800(self.power * mod800, freq + 800 * 10 ** 6, dBm80))
+        self.spectrum0.append(Band800(self.power * mod800, freq - 800 * 10 ** 6, dBm80, n_orders))
+        self.spectrum0.append(Band800(self.power * (1 - mod800 * 2), freq, dBm80, n_orders))
+        self.spectrum0.append(Band800(self.power * mod800, freq + 800 * 10 ** 6, dBm80, n_orders))
 
     def transition_rate(self, freq_0):
         rate0 = 0
@@ -83,6 +98,56 @@ class Beam:
             rate0 = rate0 + i.transition_rate(freq_0)
         return rate0
 
+    def transition_rates(self, freqs):
+        return Spectrum.from_bands(self).transition_rates(freqs)
+
+    def bands(self):
+        bands = []
+        for i in self.spectrum0:
+            bands = bands + i.bands()
+        return bands
+
     def plot(self, main_freq):
         for i in self.spectrum0:
             i.plot(main_freq)
+
+
+# the classes above are nice for building the laser, but calling transition_rate on a Beam walks through 15 Bands one
+# at a time in python. the Spectrum flattens any mix of Beams, Band800s and Bands into two arrays, the frequency and
+# the power of every line, so the cross section, the A21 cutoff and the 100 MHz cutoff can be calculated for every
+# line and every transition frequency at once with numpy broadcasting. the results are the same as transition_rate
+class Spectrum:
+    def __init__(self, freqs, powers):
+        self.freqs = np.asarray(freqs, dtype=float)  # Hz, frequency of each line
+        self.powers = np.asarray(powers, dtype=float)  # power of each line
+
+    @classmethod
+    def from_bands(cls, *sources):  # sources can be any number of Beams, Band800s and Bands
+        bands = []
+        for source in sources:
+            bands = bands + source.bands()
+        return cls([i.freq for i in bands], [i.power for i in bands])
+
+    def shifted(self, shift):  # the same spectrum with every line moved by shift (Hz)
+        return Spectrum(self.freqs + shift, self.powers)
+
+    def transition_rates(self, freqs, shifts=None):
+        # freqs can be a number or an array of transition frequencies (Hz). if shifts (Hz) is given, every line of the
+        # spectrum is moved by each shift, which is how the laser jitter is modeled. the output has the shape
+        # shifts.shape + freqs.shape, and each value is the rate summed over all lines, like Beam.transition_rate
+        return self.line_rates(freqs, shifts).sum(axis=-1)
+
+    def line_rates(self, freqs, shifts=None):  # same as transition_rates, without adding up the lines (last axis)
+        freq_0 = np.asarray(freqs, dtype=float)[..., np.newaxis]
+        line_freqs = self.freqs
+        if shifts is not None:
+            shifts = np.asarray(shifts, dtype=float)
+            line_freqs = line_freqs + shifts.reshape(shifts.shape + (1,) * freq_0.ndim)
+        rate3 = self.powers * cross_sects(line_freqs, freq_0) / (h_bar * 2 * np.pi * freq_0)
+        return np.minimum(rate3, A21)
+
+
+def cross_sects(band_freqs, freq_0):  # Band.cross_sect for arrays of Band frequencies and transition frequencies
+    delta_omega = band_freqs - freq_0
+    lorentz = res_cross_sect * (gamma / 2) ** 2 / (delta_omega ** 2 + (gamma / 2) ** 2)
+    return np.where(np.abs(delta_omega) > cutoff, 0, lorentz)
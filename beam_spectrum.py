@@ -1,24 +1,51 @@
-import matplotlib.pyplot as plt
-import numpy as np
 import copy
+from collections import namedtuple
+from functools import lru_cache
+import numpy as np
 import beam_class
+import jitter_average
+import rate_cache
 import state_data
+from instrumentation import timed
+from state_registry import registry
 Beam = beam_class.Beam
 Band = beam_class.Band
+Spectrum = beam_class.Spectrum
 abs_str = state_data.abs_str
 
+# nothing is calculated when this module is imported. the laser settings below are only the defaults, and the rates
+# are calculated the first time they are asked for, with compute_rates(config). the results are cached (see
+# rate_cache), so asking again for the same config is free. beam_spectrum.rates and beam_spectrum.num_photons still
+# work and give the rates for the default settings
+
 # this is the frequency of the laser without modulation
 main_freq = 4.475 * 10 ** 14 + 803 * 10 ** 6  # Hz, the B=0, F_g=1 -> F_e=2 transition
+detuning = 0  # Hz, moves the whole laser (every band) away from main_freq, the transitions stay where they are
 
 beam_power = 80  # total power of laser, split into many side bands
 lone_power = 20  # power of the lone band going out of the AOM, +201 MHz off the main
 mod800 = 0.30  # percent of power in the 800 MHz sidebands
 dBm80 = -14  # power of the rf source, going into the resonator (see Graphing_txt_resonator for ratios)
+eom_orders = 2  # number of 80 MHz side band orders on each side of every 800 MHz band
 polar_frac = 98 / 100  # fraction of the laser in the correct +sigma polarization
 # (we assume the incorrect polarization is split evenly with -sigma and pi)
 
-main_OP_beam = Beam(beam_power, main_freq, mod800, dBm80)
-lone_band = Band(lone_power, main_freq + 201 * 10 ** 6)
+# the laser is not at a constant frequency, so we cannot treat the transitions as always on resonance.
+# we can model the laser jitter as a sine wave and use that to find the transition rate over one period
+jitter_freq = 800000
+jitter_amp = 20 * 10 ** 6  # Hz, amplitude of the laser jitter
+n_jitter = 125  # number of times during one period of the jitter where the rate is calculated
+jitter_method = 'analytic'  # how the rate is averaged over the jitter, see jitter_average ('trapezoid' is the old way)
+
+# all the laser settings in one object. LaserConfig() gives the defaults above, LaserConfig(dBm80=-12) changes one of
+# them, and config._replace(mod800=0.25) makes a copy with a different value. it is a namedtuple so it can be used
+# as the key of a cache
+LaserConfig = namedtuple('LaserConfig', ['main_freq', 'beam_power', 'lone_power', 'mod800', 'dBm80', 'polar_frac',
+                                         'jitter_freq', 'jitter_amp', 'n_jitter', 'jitter_method', 'eom_orders',
+                                         'detuning'],
+                         defaults=[main_freq, beam_power, lone_power, mod800, dBm80, polar_frac,
+                                   jitter_freq, jitter_amp, n_jitter, jitter_method, eom_orders, detuning])
+default_config = LaserConfig()
 
 energy_g = state_data.energy_g  # in MHz, for ground states it is relative to the B = 0, F_g = 1 energy
 energy_e = state_data.energy_e  # in MHz, for excited states it is relative to the B = 0, F_e = 2 energy
@@ -28,33 +55,115 @@ for g_state, e_dict in delta_freq.items():
         delta_freq[g_state][e_state] = energy_e[e_state] - energy_g[g_state]
 # {delta_freq} gives the resonant frequency for each possible transition
 
+transitions = registry.transitions
+t_freqs = registry.t_freq
+# the same transitions as a list and an array of frequencies (MHz), in the same order, for calculating all at once
+# (see state_registry)
+
 main_transitions = [('|1, 1)', 'e|2, 2)'), ('|1,-1)', 'e|2, 0)'), ('|1, 0)', 'e|1, 1)'), ('|2,-2)', 'e|1,-1)'),
                     ('|2,-1)', 'e|2, 0)'), ('|2, 0)', 'e|2, 1)'), ('|2, 1)', 'e|2, 2)'), ('|2,-1)', 'e|1, 0)'),
                     ('|2, 2)', 'e|2, 1)'), ('|2, 2)', 'e|1, 1)')
                     ]  # for the purpose of graphing the main transitions on the spectrum
 
-# the laser is not at a constant frequency, so we cannot treat the transitions as always on resonance.
-# we can model the laser jitter as a sine wave and use that to find the transition rate over one period
-jitter_freq = 800000
-time = np.arange(0, 1 / jitter_freq, 1 / jitter_freq / 125)  # one period of the laser jitter
-jitter = 20 * 10 ** 6 * np.sin(2 * np.pi * jitter_freq * time)  # the laser jitter over one period
 
-beam_jitter_main = []
-beam_jitter_lone = []
-for i in jitter:
-    beam_jitter_main.append(Beam(beam_power, main_freq + i, mod800, dBm80))
-    beam_jitter_lone.append(Band(lone_power, main_freq + i + 201 * 10 ** 6))
-# a list of different laser spectra at different times during the jitter (different main frequencies)
+def build_beam(config=default_config):  # the main optical pumping Beam for the given settings
+    return Beam(config.beam_power, config.main_freq + config.detuning, config.mod800, config.dBm80, config.eom_orders)
+
+
+def build_lone_band(config=default_config):  # the lone band out of the AOM, +201 MHz off the main
+    return Band(config.lone_power, config.main_freq + config.detuning + 201 * 10 ** 6)
+
+
+@timed('spectrum.build')
+def build_spectrum(config=default_config):  # every line of the laser system in two arrays
+    return Spectrum.from_bands(build_beam(config), build_lone_band(config))
+
+
+def jitter_period(config=default_config):  # one period of the laser jitter, and the jitter at each time
+    time = np.arange(0, 1 / config.jitter_freq, 1 / config.jitter_freq / config.n_jitter)
+    jitter = config.jitter_amp * np.sin(2 * np.pi * config.jitter_freq * time)
+    return time, jitter
 
 
-def rate_jitter(freq):  # calculates the transition rate at each time during the beam jitter
-    rate_list = []
-    for j in range(len(beam_jitter_main)):
-        rate_list.append(beam_jitter_main[j].transition_rate(freq) + beam_jitter_lone[j].transition_rate(freq))
-    return rate_list
+@lru_cache(maxsize=None)
+def _cached_spectrum(config):
+    return build_spectrum(config)
+
+
+@timed('rate_jitter')
+def rate_jitter(freq, config=default_config):  # calculates the transition rate at each time during the beam jitter
+    # moving every line of the spectrum by the jitter gives the laser spectrum at different times during the jitter
+    # freq can also be an array of transition frequencies, then the output has the shape (len(jitter), len(freq))
+    time, jitter = jitter_period(config)
+    return _cached_spectrum(config).transition_rates(freq, shifts=jitter)
+
+
+@timed('rate_table.compute')
+def _compute_nums(config):  # the photons absorbed in 1 cm for every transition, in the order of [transitions]
+    return photon_numbers(config, registry)
+
+
+def photon_numbers(config, states):
+    # the same for the transitions of any StateRegistry [states] (see level_structure for other isotopes and fields)
+    # for every transition, averages the rate over one period of the jitter (all transitions at once)
+    # the average rate times the time spent in the 1 cm beam (1 / 20000 s) gives the total number of photons scattered
+    # by a transition in the 1 cm beam
+    nums = jitter_average.average_rates(_cached_spectrum(config), config.main_freq + states.t_freq * 10 ** 6,
+                                        config.jitter_amp, config.jitter_method, config.n_jitter) / 20000
+
+    # I correct for the reduction of maximum cross section due to the relative strengths of the transitions
+    # (t_strength). also, I account for the photons lost due to being in the wrong polarization for the transition:
+    # polar_frac of the laser is +sigma, and I assume both types of incorrect polarization (-sigma and pi) have the
+    # same population.
+    # for pi polarized light, res cross section is halved
+    return nums * states.polarization_weights(config.polar_frac) * states.t_strength
+
+
+@timed('rate_table')
+def rate_table(config=default_config):
+    # the number of photons absorbed in 1 cm for every transition, as an array in the order of [transitions]. it is
+    # calculated once per config and kept in rate_cache (in memory, and on disk if a cache directory is set), so
+    # do not change it in place
+    return rate_cache.cached('rates', config, lambda: {'num_photons': _compute_nums(config)})['num_photons']
+
+
+def compute_rates(config=default_config):
+    # returns the dictionaries {rates} (photons absorbed per second per atom) and {num_photons} (photons absorbed in
+    # 1 cm at 20000 cm/s) for every transition
+    num_photons = copy.deepcopy(state_data.allowed_transitions)  # number of photons absorbed in 1 cm, at 20000 cm/s
+    rates = copy.deepcopy(state_data.allowed_transitions)  # number of photons absorbed per second per atom
+    for (g_state, e_state), num in zip(transitions, rate_table(config)):
+        num_photons[g_state][e_state] = float(num)
+        rates[g_state][e_state] = float(num) * 20000
+        # I have the number of photons scattered in 1 cm of the beam, so by multiplying it by 20000 cm/s, I can
+        # get the average transition rate. this will be used in the differential equations
+    return rates, num_photons
+
+
+def __getattr__(name):  # the old module level results, calculated only when someone uses them
+    if name == 'rates':
+        return compute_rates()[0]
+    if name == 'num_photons':
+        return compute_rates()[1]
+    if name == 'main_OP_beam':
+        return build_beam()
+    if name == 'lone_band':
+        return build_lone_band()
+    if name == 'OP_spectrum':
+        return _cached_spectrum(default_config)
+    if name == 'time':
+        return jitter_period()[0]
+    if name == 'jitter':
+        return jitter_period()[1]
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    main_OP_beam = build_beam(default_config)
+    lone_band = build_lone_band(default_config)
+    time, jitter = jitter_period(default_config)
+
     # plots the spectrum and transitions
     plt.title('Spectrum')
     plt.xlabel('Frequency')
@@ -70,7 +179,7 @@ if __name__ == '__main__':
     lone_band.plot(main_freq)
     offset = 0
     for k, l in main_transitions:
-        if float(k[3:5]) < float(l[4:6]):
+        if registry.sigma_plus[registry.transition_index[(k, l)]]:
             plt.annotate(k + '->' + l, xy=(delta_freq[k][l] * 10 ** 6, 0), xytext=(0, 50 + offset),
                          textcoords='offset points', arrowprops=dict(facecolor='green', shrink=0.05),
                          color='green', weight='extra bold')
@@ -91,7 +200,7 @@ if __name__ == '__main__':
     offset = 0
     for k, l in delta_freq.items():
         for m, n in l.items():
-            if float(k[3:5]) < float(m[4:6]):
+            if registry.sigma_plus[registry.transition_index[(k, m)]]:
                 plt.annotate(k + '->' + m, xy=(n * 10 ** 6, 0), xytext=(0, 80 - n / 6), textcoords='offset points',
                              arrowprops=dict(facecolor='green', shrink=0.05), color='green', weight='extra bold')
                 offset = offset + 5
@@ -105,7 +214,7 @@ if __name__ == '__main__':
     offset = 0
     for k, l in delta_freq.items():
         for m, n in l.items():
-            if not (float(k[3:5]) < float(m[4:6])):
+            if not registry.sigma_plus[registry.transition_index[(k, m)]]:
                 plt.annotate(k + '->' + m, xy=(n * 10 ** 6, 0), xytext=(0, 80 - n / 6), textcoords='offset points',
                              arrowprops=dict(facecolor='red', shrink=0.05), color='red', weight='extra bold')
                 offset = offset + 5
@@ -143,31 +252,6 @@ if __name__ == '__main__':
           np.trapz(n_150_jitter, x=time) * jitter_freq / 20000)
     plt.show()
 
-num_photons = copy.deepcopy(state_data.allowed_transitions)  # number of photons absorbed in 1 cm, at 20000 cm/s
-rates = copy.deepcopy(state_data.allowed_transitions)  # number of photons absorbed per second per atom
-
-for g_state, e_dict in delta_freq.items():
-    for e_state, t_freq in e_dict.items():
-        # for every transition, integrates rate vs time for one period
-        # multiplying it by the number of periods of laser jitter in 1 cm gives the total number of photons scattered
-        # by a transition in the 1 cm beam
-        num = np.trapz(rate_jitter(main_freq + t_freq * 10 ** 6), x=time) * jitter_freq / 20000
-        if float(g_state[3:5]) < float(e_state[4:6]):  # for +sigma polarized light
-            num_photons[g_state][e_state] = num * polar_frac * abs_str[g_state][e_state]
-            # above, I correct for the reduction of maximum cross section due to the relative strengths of the
-            # transitions. also, I account for the photons lost due to being in the wrong polarization for the
-            # transition
-            rates[g_state][e_state] = num * polar_frac * abs_str[g_state][e_state] * 20000
-            # I have the number of photons scattered in 1 cm of the beam, so by multiplying it by 20000 cm/s, I can
-            # get the average transition rate. this will be used in the differential equations
-        elif float(g_state[3:5]) == float(e_state[4:6]):  # for pi polarized light, res cross section is halved
-            num_photons[g_state][e_state] = num * ((1 - polar_frac) / 2) * abs_str[g_state][e_state] / 2
-            rates[g_state][e_state] = num * ((1 - polar_frac) / 2) * abs_str[g_state][e_state] * 20000 / 2
-        else:  # for -sigma polarized light
-            num_photons[g_state][e_state] = num * ((1 - polar_frac) / 2) * abs_str[g_state][e_state]
-            rates[g_state][e_state] = num * ((1 - polar_frac) / 2) * abs_str[g_state][e_state] * 20000
-            # I assume both types of incorrect polarization have the same population
-
-print('###############################################################################################################')
-print('the number of photons scattered by each transition over 1 cm of optical pumping, with polarization')
-print(num_photons)
+    print('###########################################################################################################')
+    print('the number of photons scattered by each transition over 1 cm of optical pumping, with polarization')
+    print(compute_rates()[1])
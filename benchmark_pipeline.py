@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import beam_class
+import beam_spectrum as spec
+import Graphing_txt_resonator as Mod
+import jitter_average
+import OP_graph_model as model
+import parameter_sweep
+import rate_cache
+import steady_state
+
+# benchmarks for every stage of the pipeline: the laser spectrum (Band / Beam / Spectrum), the EOM side band
+# interpolation, the jitter averaging, the rate equations, and a small sweep, plus scaling cases over the number of
+# jitter samples, the number of lines in the spectrum and the number of sweep points.
+# every case also returns its result, which is checked against the reference values in benchmark_reference.json
+# (made with the default LaserConfig), so an optimization that changes the physics fails the benchmark.
+# it runs offline with only numpy and scipy:
+#     python benchmark_pipeline.py                  runs everything and checks the results
+#     python benchmark_pipeline.py -k jitter        only the cases with 'jitter' in their name
+#     python benchmark_pipeline.py --json out.json  also saves the timings
+#     python benchmark_pipeline.py --update         rewrites the reference values (only after checking the physics)
+# it exits with 1 if any result does not match its reference
+
+reference_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_reference.json')
+
+cases = []  # (name, function, relative tolerance of the check)
+
+
+def case(name, rtol=10 ** -9):  # decorator that adds a function to the benchmark cases
+    def add(function):
+        cases.append((name, function, rtol))
+        return function
+    return add
+
+
+def clear_caches():  # so the cases measure the calculation and not a cache lookup
+    rate_cache.cache.clear()
+    spec._cached_spectrum.cache_clear()
+    model._solve_pumping.cache_clear()
+
+
+config = spec.default_config
+t_freqs = config.main_freq + spec.t_freqs * 10 ** 6  # Hz, every transition frequency
+gr = spec.compute_rates(config)[0]
+
+
+# the laser spectrum
+@case('band.transition_rate')
+def band_transition_rate():
+    band = beam_class.Band(config.beam_power, config.main_freq)
+    return [band.transition_rate(f) for f in t_freqs]
+
+
+@case('beam.transition_rate')
+def beam_transition_rate():
+    beam = spec.build_beam(config)
+    return [beam.transition_rate(f) for f in t_freqs]
+
+
+@case('beam.build')
+def beam_build():
+    return spec.build_beam(config).transition_rates(t_freqs)
+
+
+@case('spectrum.transition_rates_jitter')  # all lines x all transitions x all jitter samples at once
+def spectrum_transition_rates():
+    return spec.build_spectrum(config).transition_rates(t_freqs, shifts=spec.jitter_period(config)[1]).sum(axis=0)
+
+
+@case('band_strength')
+def band_strength():
+    return [Mod.band_strength(dBm, band) for dBm in np.arange(-24.5, -9.5, 0.5) for band in (1, 2, 3)]
+
+
+@case('sideband_model.strengths', rtol=10 ** -6)  # the table in one vectorized call, and the Bessel model
+def sideband_strengths():
+    model = Mod.sideband_model()
+    return np.concatenate([model.strengths(np.arange(-24.5, -9.5, 0.5), (0, 1, 2)).ravel(),
+                           model.strengths(np.arange(-40, 0, 0.5), range(6), 'bessel').ravel()])
+
+
+# the jitter averaging
+@case('rate_jitter.all_transitions')
+def rate_jitter():
+    return spec.rate_jitter(t_freqs, config).sum(axis=0)
+
+
+for method in jitter_average.methods:
+    def average(method=method):
+        spectrum = spec.build_spectrum(config)
+        return jitter_average.average_rates(spectrum, t_freqs, config.jitter_amp, method, config.n_jitter)
+    case('jitter_average.' + method, rtol=10 ** -6 if method == 'quad' else 10 ** -9)(average)
+
+
+@case('rate_table')
+def rate_table():
+    clear_caches()
+    return spec.rate_table(config)
+
+
+# the rate equations
+@case('state_rates')
+def state_rates():
+    return model.state_rates(0, model.v_input, gr)
+
+
+@case('generator')
+def generator():
+    clear_caches()
+    return model.generator(config)
+
+
+@case('solve_ivp.legacy', rtol=10 ** -6)  # the original solve_ivp runs of OP_graph_model (RK45 calling state_rates)
+def solve_legacy():
+    clear_caches()
+    OP_model_input, OP_model_ring = model.solve_pumping(config, method='legacy')
+    return np.concatenate([OP_model_input.y[:, -1], OP_model_ring.y[:, -1]])
+
+
+@case('solve_pumping.eig')
+def solve_eig():
+    clear_caches()
+    OP_model_input, OP_model_ring = model.solve_pumping(config)
+    return np.concatenate([OP_model_input.y[:, -1], OP_model_ring.y[:, -1]])
+
+
+@case('solve_pumping.expm')
+def solve_expm():
+    clear_caches()
+    OP_model_input, OP_model_ring = model.solve_pumping(config, method='expm')
+    return np.concatenate([OP_model_input.y[:, -1], OP_model_ring.y[:, -1]])
+
+
+@case('solve_batch.ground_states')
+def solve_batch():
+    return model.solve_batch([config])[0, :, :, -1].ravel()
+
+
+@case('steady_state.polar_frac_1', rtol=10 ** -6)  # badly conditioned eigenvectors, the expm fallback of the solver
+def steady_state_pure_polarization():
+    result = steady_state.analyze(config._replace(polar_frac=1.0))
+    return np.concatenate([result.stationary, [result.pumping_time]])
+
+
+# scaling with the number of jitter samples
+for n_jitter in (32, 125, 512):
+    for method in ('trapezoid', 'chebyshev'):
+        def samples(n_jitter=n_jitter, method=method):
+            spectrum = spec.build_spectrum(config)
+            return jitter_average.average_rates(spectrum, t_freqs, config.jitter_amp, method, n_jitter)
+        case('scaling.jitter_samples.' + method + '.' + str(n_jitter))(samples)
+
+
+# scaling with the number of lines (side bands) in the spectrum, evenly spread over the transitions
+for n_lines in (16, 64, 256):
+    for method in ('analytic', 'chebyshev'):
+        def lines(n_lines=n_lines, method=method):
+            spectrum = beam_class.Spectrum(config.main_freq + np.linspace(-1200, 1200, n_lines) * 10 ** 6,
+                                           np.full(n_lines, config.beam_power / n_lines))
+            return jitter_average.average_rates(spectrum, t_freqs, config.jitter_amp, method, config.n_jitter)
+        case('scaling.lines.' + method + '.' + str(n_lines))(lines)
+
+
+# scaling with the number of sweep points (in this process, with the caches cleared)
+for n_points in (1, 4, 16):
+    def sweep(n_points=n_points):
+        clear_caches()
+        points = [{'dBm80': dBm} for dBm in np.linspace(-20, -10, n_points)]
+        return parameter_sweep.sweep(points, workers=1)['efficiency']
+    case('scaling.sweep_points.' + str(n_points))(sweep)
+
+
+def measure(function, min_time=0.2, repeats=3):
+    # calls function in a loop for at least min_time seconds, [repeats] times, and returns the fastest time per call
+    function()  # warm up (imports, data files)
+    best = np.inf
+    for i in range(repeats):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            function()
+            calls = calls + 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / calls)
+    return best
+
+
+def run(keyword='', update=False, min_time=0.2, repeats=3):
+    # runs the cases with keyword in their name. returns a list of dictionaries with the name, the time per call, and
+    # whether the result matched the reference
+    references = {}
+    if os.path.exists(reference_file):
+        with open(reference_file) as file:
+            references = json.load(file)
+    results = []
+    for name, function, rtol in cases:
+        if keyword not in name:
+            continue
+        value = np.asarray(function(), dtype=float).ravel()
+        if update:
+            references[name] = value.tolist()
+            status = 'updated'
+        elif name not in references:
+            status = 'no reference'
+        elif len(references[name]) != len(value) or not np.allclose(value, references[name], rtol=rtol, atol=0):
+            status = 'FAILED'
+        else:
+            status = 'ok'
+        seconds = measure(function, min_time, repeats)
+        results.append({'name': name, 'seconds': seconds, 'status': status})
+        print('%-45s %12.3f ms   %s' % (name, seconds * 1000, status))
+    if update:
+        with open(reference_file, 'w') as file:
+            json.dump(references, file, indent=1, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks for the optical pumping model')
+    parser.add_argument('-k', '--keyword', default='', help='only run the cases with this in their name')
+    parser.add_argument('--update', action='store_true', help='rewrite the reference values')
+    parser.add_argument('--json', help='save the timings to this file')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds each case is repeated for')
+    parser.add_argument('--repeats', type=int, default=3, help='number of repeats, the fastest one is used')
+    args = parser.parse_args()
+
+    benchmark_results = run(args.keyword, args.update, args.min_time, args.repeats)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(benchmark_results, file, indent=1)
+    if any(i['status'] == 'FAILED' for i in benchmark_results):
+        sys.exit(1)
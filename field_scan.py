@@ -0,0 +1,146 @@
+from functools import lru_cache
+import numpy as np
+import beam_class
+import beam_spectrum as spec
+import jitter_average
+import level_structure
+import OP_graph_model as model
+from state_registry import StateRegistry, registry
+
+# scans of the magnetic field and of the atom velocity (Doppler shift). for a given laser config the jitter averaged
+# rate only depends on the transition frequency, so instead of rebuilding the spectrum and averaging over the jitter
+# for every transition of every scan point, the rate is calculated once on a dense grid of frequencies (RateTable,
+# every line of the spectrum on every grid point) and the scan points only interpolate it:
+#     - a field scan moves the transition frequencies and changes the strengths (the states mix with the field). the
+#       levels of every field are found at once with level_structure.hyperfine_scan
+#     - a velocity scan shifts every transition by main_freq * v / c. v is the velocity along the laser beam (cm/s),
+#       positive for atoms moving away from the laser, which see the laser at a lower frequency
+# the rate equations of all scan points are then solved together with OP_graph_model.propagate
+
+speed_of_light = 2.99792458 * 10 ** 10  # cm/s
+
+
+class RateTable:
+    def __init__(self, config=spec.default_config, step=0.02):
+        # the jitter averaged rate (photons per second, before the polarization and strength corrections, like
+        # jitter_average.average_rates) on a grid of transition frequencies spaced by step (MHz). the grid covers
+        # every frequency a line can reach, the rate is 0 further away than that
+        spectrum = spec.build_spectrum(config)
+        reach = beam_class.cutoff + config.jitter_amp
+        low = np.floor((spectrum.freqs.min() - reach - config.main_freq) / 10 ** 6) - 1
+        high = np.ceil((spectrum.freqs.max() + reach - config.main_freq) / 10 ** 6) + 1
+        self.config = config
+        self.offsets = np.arange(low, high + step / 2, step)  # MHz relative to main_freq, like state_registry.t_freq
+        self.rates = jitter_average.average_rates(spectrum, config.main_freq + self.offsets * 10 ** 6,
+                                                  config.jitter_amp, config.jitter_method, config.n_jitter)
+
+    def __call__(self, offsets):  # the rate at transition frequencies offsets (MHz relative to main_freq)
+        return np.interp(offsets, self.offsets, self.rates, left=0, right=0)
+
+    def photon_numbers(self, t_freq, t_strength, t_weights):
+        # like beam_spectrum.photon_numbers for transitions with frequencies t_freq (MHz) and strengths t_strength,
+        # where t_weights is the polarization_weights. all of them can be stacks over scan points
+        return self(t_freq) / 20000 * t_weights * t_strength
+
+
+@lru_cache(maxsize=16)
+def rate_table(config=spec.default_config, step=0.02):  # the RateTable of config, made once
+    return RateTable(config, step)
+
+
+def doppler_shift(velocities, config=spec.default_config):  # MHz, how much the transitions move for the atom
+    return config.main_freq * np.asarray(velocities, dtype=float) / speed_of_light / 10 ** 6
+
+
+class FieldLevels:
+    def __init__(self, isotope='Li7', line='D1', fields=(145,)):
+        # the levels of isotope and line at every field in fields (G). all pairs of ground and excited states with
+        # |change in m_F| <= 1 are kept as transitions (some strengths are 0 at B = 0), so every field has the same
+        # transitions. registry has the states and transitions (with the strengths of the first field), and
+        # t_freq (MHz), t_strength and emission (the emission generator) have the values of every field
+        self.fields = np.atleast_1d(np.asarray(fields, dtype=float))
+        g_states, g_energies, g_vectors = level_structure.hyperfine_scan(isotope, 'S1/2', self.fields)
+        e_states, e_energies, e_vectors = level_structure.hyperfine_scan(isotope, level_structure.lines[line],
+                                                                         self.fields)
+        dipole = level_structure.dipole_matrix(isotope, line)
+        strengths = (e_vectors @ dipole @ np.swapaxes(g_vectors, 1, 2)) ** 2  # (fields, excited, ground)
+
+        g_labels = [level_structure.label(F, m) for F, m in g_states]
+        e_labels = [level_structure.label(F, m, True) for F, m in e_states]
+        pairs = [(j, i) for j, (F_g, m_g) in enumerate(g_states) for i, (F_e, m_e) in enumerate(e_states)
+                 if abs(m_e - m_g) <= 1]
+        emit_str = {e_labels[i]: {} for i in range(len(e_labels))}
+        for j, i in pairs:
+            emit_str[e_labels[i]][g_labels[j]] = float(strengths[0, i, j])
+        allowed_transitions = {g_state: {} for g_state in g_labels}
+        for j, i in pairs:
+            allowed_transitions[g_labels[j]][e_labels[i]] = 0
+        self.registry = StateRegistry(dict(zip(g_labels, g_energies[0])), dict(zip(e_labels, e_energies[0])),
+                                      allowed_transitions, emit_str)
+
+        n_ground = len(g_labels)
+        t_g = self.registry.t_ground
+        t_e = self.registry.t_excited - n_ground
+        self.t_freq = e_energies[:, t_e] - g_energies[:, t_g]  # (fields, transitions)
+        self.t_strength = strengths[:, t_e, t_g]
+        n = self.registry.n_states
+        self.emission = np.zeros((len(self.fields), n, n))
+        excited = np.arange(n_ground, n)
+        self.emission[:, excited, excited] = -beam_class.A21 * strengths.sum(axis=-1)
+        self.emission[:, :n_ground, n_ground:] = beam_class.A21 * np.swapaxes(strengths, 1, 2)
+
+
+def _result(M, v0, times, labels, **scan):
+    from scipy.optimize import OptimizeResult
+    times = np.atleast_1d(np.asarray(times, dtype=float))
+    y = model.propagate(M, v0, times)
+    return OptimizeResult(t=times, y=y, final=y[..., -1], labels=labels, **scan)
+
+
+def scan_velocity(velocities, config=spec.default_config, structure=None, v0=model.v_input, times=model.t_end,
+                  step=0.02):
+    # solves the rate equations for every velocity (cm/s, along the laser) in velocities, with the level structure
+    # structure (level_structure.LevelStructure, state_data if None). returns a result with .y of shape
+    # (len(velocities), n_states, len(times)), .final the populations at the last time, and .num_photons the
+    # photons absorbed in 1 cm for every velocity and transition
+    states = registry if structure is None else structure.registry
+    velocities = np.asarray(velocities, dtype=float)
+    t_freq = states.t_freq + doppler_shift(velocities, config)[..., np.newaxis]
+    nums = rate_table(config, step).photon_numbers(t_freq, states.t_strength,
+                                                   states.polarization_weights(config.polar_frac))
+    M = states.absorption_matrix(nums * 20000) + states.emission_matrix(beam_class.A21)
+    return _result(M, v0, times, states.labels, velocities=velocities, num_photons=nums)
+
+
+def scan_field(fields, config=spec.default_config, isotope='Li7', line='D1', v0=None, times=model.t_end,
+               velocity=0, step=0.02):
+    # solves the rate equations for every magnetic field (G) in fields, for atoms with the velocity [velocity] (cm/s
+    # along the laser). v0 is the initial populations (100% in the first ground state, |F,-F), if None). returns a
+    # result like scan_velocity, with .fields and .levels (the FieldLevels)
+    levels = FieldLevels(isotope, line, fields)
+    states = levels.registry
+    if v0 is None:
+        v0 = 100 * np.eye(states.n_states)[0]
+    nums = rate_table(config, step).photon_numbers(levels.t_freq + doppler_shift(velocity, config), levels.t_strength,
+                                                   states.polarization_weights(config.polar_frac))
+    M = states.absorption_matrix(nums * 20000) + levels.emission
+    return _result(M, v0, times, states.labels, fields=levels.fields, levels=levels, num_photons=nums)
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    fields = np.linspace(100, 200, 1001)
+    field_result = scan_field(fields)
+    plt.plot(fields, field_result.final[:, 4])
+    plt.title('Percent of atoms in |2, 2) after 1 cm vs magnetic field (levels from level_structure)')
+    plt.xlabel('B (G)')
+    plt.ylabel('Percent')
+    plt.show()
+
+    velocities = np.linspace(-2000, 2000, 1001)
+    velocity_result = scan_velocity(velocities)
+    plt.plot(velocities, velocity_result.final[:, 4])
+    plt.title('Percent of atoms in |2, 2) after 1 cm vs velocity along the laser')
+    plt.xlabel('Velocity (cm/s)')
+    plt.ylabel('Percent')
+    plt.show()
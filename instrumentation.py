@@ -0,0 +1,203 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# measures where the time goes in the pipeline (spectrum -> jitter average -> rate table -> generator -> solver).
+# the stages of the other modules are marked with the decorator @timed('name') or with profile.stage('name'), and
+# things that are counted (state_rates calls, solver steps, cache hits) with profile.count('name'). nothing is
+# recorded unless profiling is on, and then the only cost of a marked function is one check of profile.active.
+# profiling is turned on
+#     - for a whole run with the environment variable OP_PROFILE. OP_PROFILE=1 prints a report at the end, any other
+#       value is a file the report is saved to at the end (a Chrome trace if it ends with .trace.json, the folded
+#       stacks for flamegraph.pl / speedscope if it ends with .folded, and a json report otherwise)
+#     - for part of a run with the context manager: with profiling() as p: ..., then p.report() or p.save_json(path)
+# the processes of a pool (parameter_sweep with workers > 1) are not recorded, use workers=1 to profile a sweep.
+# this module only uses the standard library, so every other module can import it
+
+trace_suffix = '.trace.json'
+folded_suffix = '.folded'
+
+
+class Profile:
+    def __init__(self):
+        self.active = False
+        self.reset()
+
+    def reset(self):  # forgets everything recorded so far
+        self.stages = {}  # name -> [calls, seconds]
+        self.counters = {}  # name -> count
+        self.events = []  # (name, start, seconds, thread) of every stage, for the trace
+        self.folded = {}  # 'outer;inner' -> seconds spent in inner itself (not in the stages it calls)
+        self.notes = set()  # what the counters leave out, shown at the end of the report
+        self.origin = time.perf_counter()
+        self._stacks = threading.local()
+
+    @contextmanager
+    def stage(self, name):  # times the code in the with block as the stage name
+        if not self.active:
+            yield
+            return
+        stack = self._stack()
+        stack.append([name, 0.0])  # the name, and the time spent in the stages called from this one
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            name, inner = stack.pop()
+            if stack:
+                stack[-1][1] = stack[-1][1] + seconds
+            record = self.stages.setdefault(name, [0, 0.0])
+            record[0] = record[0] + 1
+            record[1] = record[1] + seconds
+            self.events.append((name, start - self.origin, seconds, threading.get_ident()))
+            path = ';'.join([i[0] for i in stack] + [name])
+            self.folded[path] = self.folded.get(path, 0.0) + seconds - inner
+
+    def count(self, name, n=1):  # adds n to the counter name
+        if self.active:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def note(self, text):  # adds a note to the report
+        if self.active:
+            self.notes.add(text)
+
+    def report(self):  # a dictionary with the calls and seconds of every stage, the counters and the notes
+        report = {'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in
+                             sorted(self.stages.items(), key=lambda item: -item[1][1])},
+                  'counters': dict(sorted(self.counters.items()))}
+        if self.notes:
+            report['notes'] = sorted(self.notes)
+        return report
+
+    def summary(self):  # the report as a table of text
+        lines = ['%-40s %10s %12s' % ('stage', 'calls', 'seconds')]
+        for name, record in self.report()['stages'].items():
+            lines.append('%-40s %10d %12.6f' % (name, record['calls'], record['seconds']))
+        lines.append('')
+        lines.append('%-40s %10s' % ('counter', 'count'))
+        for name, count in self.report()['counters'].items():
+            lines.append('%-40s %10d' % (name, count))
+        if self.notes:
+            lines.append('')
+            lines.extend('note: ' + text for text in sorted(self.notes))
+        return '\n'.join(lines)
+
+    def save_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=1)
+
+    def save_trace(self, path):
+        # the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev or speedscope), which shows the
+        # stages as a flame chart over time. the counters are added as one counter event at the end
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': start * 10 ** 6, 'dur': seconds * 10 ** 6, 'pid': pid, 'tid': tid}
+                  for name, start, seconds, tid in self.events]
+        end = max([start + seconds for name, start, seconds, tid in self.events], default=0)
+        if self.counters:
+            events.append({'name': 'counters', 'ph': 'C', 'ts': end * 10 ** 6, 'pid': pid, 'tid': 0,
+                           'args': self.counters})
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+    def save_folded(self, path):  # one 'outer;inner microseconds' line per stack, the input of flamegraph.pl
+        with open(path, 'w') as file:
+            for stack, seconds in sorted(self.folded.items()):
+                file.write(stack + ' ' + str(int(round(seconds * 10 ** 6))) + '\n')
+
+    def save(self, path):  # picks the format from the end of the file name, see the top of the module
+        if path.endswith(trace_suffix):
+            self.save_trace(path)
+        elif path.endswith(folded_suffix):
+            self.save_folded(path)
+        else:
+            self.save_json(path)
+
+    def _stack(self):  # the stages that are running in this thread
+        if not hasattr(self._stacks, 'stack'):
+            self._stacks.stack = []
+        return self._stacks.stack
+
+
+profile = Profile()  # the profile every module records into
+
+
+def timed(name):  # decorator that times every call of a function as the stage name
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profile.active:
+                return function(*args, **kwargs)
+            with profile.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    profile.count(name, n)
+
+
+@contextmanager
+def profiling(reset=True):  # turns profiling on for the with block, and gives the profile
+    active = profile.active
+    if reset:
+        profile.reset()
+    profile.active = True
+    try:
+        yield profile
+    finally:
+        profile.active = active
+
+
+def solver(method):
+    # returns the solve_ivp method (a name like 'RK45', or an OdeSolver class) as a class that counts its steps when
+    # profiling is on, and the method itself when it is off. for the explicit Runge-Kutta methods (RK23, RK45,
+    # DOP853) the rejected steps are counted too: every try of a step calls the function n_stages times. the implicit
+    # methods (BDF, Radau, LSODA) retry a rejected step inside _step_impl without a sign of it outside, so their
+    # rejected steps are not counted, and the report says so
+    if not profile.active:
+        return method
+    if isinstance(method, str):
+        import scipy.integrate
+        method = getattr(scipy.integrate, method)
+
+    if getattr(method, 'n_stages', None) is None:
+        profile.note('solver.rejected_steps does not count the rejected steps of ' + method.__name__)
+
+    class Counted(method):
+        def _step_impl(self):
+            nfev = self.nfev
+            result = super()._step_impl()
+            profile.count('solver.steps')
+            n_stages = getattr(self, 'n_stages', None)
+            if n_stages is not None and result[0]:
+                profile.count('solver.rejected_steps', (self.nfev - nfev) // n_stages - 1)
+            return result
+    Counted.__name__ = method.__name__
+    return Counted
+
+
+def record_solver(result):  # counts the function evaluations and factorizations of a solve_ivp result
+    for name in ('nfev', 'njev', 'nlu'):
+        count('solver.' + name, getattr(result, name, 0))
+    count('solver.solves')
+
+
+_output = os.environ.get('OP_PROFILE', '')
+
+
+def _finish():  # prints or saves the report of a run with OP_PROFILE set (only this process, not a process pool)
+    if _output == '1':
+        print(profile.summary())
+    else:
+        profile.save(_output)
+
+
+if _output and _output != '0':
+    profile.active = True
+    atexit.register(_finish)
@@ -0,0 +1,169 @@
+import numpy as np
+import beam_class
+from instrumentation import timed
+
+# this module averages the transition rates over one period of the laser jitter. the jitter is a sine wave,
+# shift = amplitude * sin(2 pi jitter_freq t), so the average over one period does not depend on jitter_freq, and
+# with x = sin(2 pi jitter_freq t) it is
+#     average rate = (1 / pi) * integral from -1 to 1 of rate(amplitude * x) / sqrt(1 - x ** 2) dx
+# the methods below are different ways of calculating this integral:
+#     'analytic'  - the average of a Lorentzian under a sinusoidal sweep has a closed form (see lorentz_average). it is
+#                   used for every line that never reaches A21 (no saturation) and stays inside the 100 MHz cutoff for
+#                   the whole period. lines that are always outside the cutoff give 0. the lines that cross the cutoff
+#                   or saturate are split into pieces at the crossings, where the rate is either 0, A21 or a smooth
+#                   Lorentzian, and the Lorentzian pieces are integrated with [n_gauss] point Gauss-Legendre quadrature
+#     'quad'      - adaptive quadrature (scipy.integrate.quad_vec) with relative error tolerance [tol], started with
+#                   the same crossings as breakpoints
+#     'chebyshev' - Gauss-Chebyshev quadrature with [n] points. the 1 / sqrt(1 - x ** 2) is the density of a sine wave,
+#                   so this is exact for rates that are polynomials of degree < 2n in the shift
+#     'trapezoid' - the original method: np.trapz over [n] intervals covering one period. the rate has kinks at the
+#                   cutoffs and at saturation, so this converges slowly
+# the output is the average rate (photons per second per atom) for each transition frequency, before correcting for
+# the polarization and the relative strength of the transition (that happens in beam_spectrum)
+# line_derivatives gives the 'analytic' average of every line separately, with its derivatives with respect to the
+# power and the frequency of the line, for the gradients in laser_optimizer
+
+A21 = beam_class.A21
+gamma = beam_class.gamma
+res_cross_sect = beam_class.res_cross_sect
+h_bar = beam_class.h_bar
+cutoff = beam_class.cutoff
+
+methods = ['analytic', 'quad', 'chebyshev', 'trapezoid']
+
+
+@timed('jitter_average')
+def average_rates(spectrum, freqs, amplitude, method='analytic', n=125, tol=10 ** -8, n_gauss=32):
+    # spectrum is a beam_class.Spectrum, freqs is an array of transition frequencies (Hz) and amplitude is the
+    # amplitude of the jitter (Hz). returns the average rate over one period, with the same shape as freqs
+    freqs = np.asarray(freqs, dtype=float)
+    if method == 'analytic':
+        return _analytic(spectrum, freqs, amplitude, n_gauss)
+    if method == 'quad':
+        freq_0 = freqs[..., np.newaxis]
+        scale = spectrum.powers * res_cross_sect / (h_bar * 2 * np.pi * freq_0)
+        points = np.unique(_kinks(spectrum.freqs - freq_0, scale, amplitude))
+        points = points[(points > -np.pi / 2) & (points < np.pi / 2)]
+        return _quad(lambda shift: spectrum.transition_rates(freqs, shifts=shift), amplitude, tol, points)
+    if method == 'chebyshev':
+        x = np.cos((2 * np.arange(1, n + 1) - 1) * np.pi / (2 * n))  # the Gauss-Chebyshev points, all weights 1/n
+        return spectrum.transition_rates(freqs, shifts=amplitude * x).mean(axis=0)
+    if method == 'trapezoid':
+        phase = np.linspace(0, 1, n + 1)
+        weights = np.full(n + 1, 1 / n)  # the same as np.trapz(rates, x=phase)
+        weights[0] = weights[-1] = 1 / (2 * n)
+        return np.tensordot(weights, spectrum.transition_rates(freqs, shifts=amplitude * np.sin(2 * np.pi * phase)),
+                            axes=1)
+    raise ValueError('unknown jitter averaging method ' + repr(method) + ', use one of ' + str(methods))
+
+
+def lorentz_average(delta, amplitude):
+    # the average over one period of (gamma/2)**2 / ((delta + amplitude * sin)**2 + (gamma/2)**2). with b = gamma/2,
+    # 1 / (x**2 + b**2) = Re(1 / (b - i x)) / b, and the average of 1 / (c + a sin) over a period is
+    # 1 / sqrt(c**2 - a**2) (principal square root, for Re(c) > 0), which gives
+    # b * Re(1 / sqrt((b - i delta)**2 + amplitude**2))
+    b = gamma / 2
+    return b * np.real(1 / np.sqrt((b - 1j * delta) ** 2 + amplitude ** 2))
+
+
+def lorentz_average_slope(delta, amplitude):  # the derivative of lorentz_average with respect to delta
+    b = gamma / 2
+    root = np.sqrt((b - 1j * delta) ** 2 + amplitude ** 2)
+    return b * np.real(1j * (b - 1j * delta) / root ** 3)
+
+
+def _kinks(delta, scale, amplitude):
+    # the phases theta (shift = amplitude * sin(theta), theta from -pi/2 to pi/2) where the rate of a line with
+    # detuning delta and rate scale * Lorentzian crosses the 100 MHz cutoff, starts or stops saturating at A21, or is
+    # on resonance. the rate is smooth between them. returns an array with 7 phases per line (last axis), sorted.
+    # crossings that do not happen are moved to -pi/2 or pi/2
+    b = gamma / 2
+    d_sat = b * np.sqrt(np.maximum(scale / A21 - 1, 0))  # the detuning where the rate reaches A21
+    x = np.stack([-cutoff - delta, -d_sat - delta, -delta, d_sat - delta, cutoff - delta,
+                  np.full_like(delta, -amplitude), np.full_like(delta, amplitude)], axis=-1)
+    if amplitude == 0:
+        return np.sort(np.where(x < 0, -np.pi / 2, np.pi / 2), axis=-1)
+    return np.sort(np.arcsin(np.clip(x / amplitude, -1, 1)), axis=-1)
+
+
+def _quad(rates, amplitude, tol, points=None):  # adaptive quadrature of rates(shift) over one period
+    from scipy.integrate import quad_vec
+    # theta from -pi/2 to pi/2 covers every shift once, and is half of a period, so dividing by pi gives the average
+    # the tolerance is relative to the largest value of the output
+    return quad_vec(lambda theta: rates(amplitude * np.sin(theta)), -np.pi / 2, np.pi / 2, epsabs=0, epsrel=tol,
+                    norm='max', points=points, limit=10000)[0] / np.pi
+
+
+def _analytic(spectrum, freqs, amplitude, n_gauss):
+    freq_0 = freqs[..., np.newaxis]
+    delta = spectrum.freqs - freq_0  # every transition frequency against every line, the last axis is the lines
+    nearest = np.maximum(np.abs(delta) - amplitude, 0)  # the closest the jittering line gets to the transition
+    scale = spectrum.powers * res_cross_sect / (h_bar * 2 * np.pi * freq_0)
+    peak = scale * (gamma / 2) ** 2 / (nearest ** 2 + (gamma / 2) ** 2)  # the largest rate during the period
+    exact = (np.abs(delta) + amplitude <= cutoff) & (peak <= A21)
+    piecewise = ~exact & (nearest <= cutoff)
+
+    average = np.where(exact, scale * lorentz_average(delta, amplitude), 0)
+    if np.any(piecewise):
+        average[piecewise] = _piecewise(delta[piecewise], np.broadcast_to(scale, delta.shape)[piecewise], amplitude,
+                                        n_gauss)
+    return average.sum(axis=-1)
+
+
+def line_derivatives(spectrum, freqs, amplitude, n_gauss=32):
+    # the 'analytic' average rate of every line of the spectrum for each transition frequency in freqs (the sum over
+    # the lines is average_rates(..., 'analytic')), and its derivatives with respect to the power of the line and the
+    # frequency of the line (per Hz). returns three arrays of shape freqs.shape + (number of lines,)
+    freqs = np.asarray(freqs, dtype=float)
+    freq_0 = freqs[..., np.newaxis]
+    delta = spectrum.freqs - freq_0
+    nearest = np.maximum(np.abs(delta) - amplitude, 0)
+    per_power = np.broadcast_to(res_cross_sect / (h_bar * 2 * np.pi * freq_0), delta.shape)  # the rate per power
+    scale = spectrum.powers * per_power
+    peak = scale * (gamma / 2) ** 2 / (nearest ** 2 + (gamma / 2) ** 2)
+    exact = (np.abs(delta) + amplitude <= cutoff) & (peak <= A21)
+    piecewise = ~exact & (nearest <= cutoff)
+
+    lorentz = np.where(exact, lorentz_average(delta, amplitude), 0)
+    average = scale * lorentz
+    d_power = per_power * lorentz
+    d_freq = np.where(exact, scale * lorentz_average_slope(delta, amplitude), 0)
+    if np.any(piecewise):
+        average[piecewise], d_power[piecewise], d_freq[piecewise] = _piecewise(
+            delta[piecewise], scale[piecewise], amplitude, n_gauss, per_power[piecewise])
+    return average, d_power, d_freq
+
+
+def _piecewise(delta, scale, amplitude, n_gauss, per_power=None):
+    # the average rate of lines that cross the cutoff or saturate. between two kinks the rate is smooth, so each piece
+    # is integrated with Gauss-Legendre quadrature (all lines and pieces at once). if per_power (the rate per power of
+    # each line) is given, also returns the derivatives with respect to the power and the frequency of each line
+    kinks = _kinks(delta, scale, amplitude)  # (lines, 7)
+    edges = np.concatenate([np.full(delta.shape + (1,), -np.pi / 2), kinks, np.full(delta.shape + (1,), np.pi / 2)],
+                           axis=-1)
+    middle = (edges[:, 1:] + edges[:, :-1]) / 2  # (lines, pieces)
+    half = (edges[:, 1:] - edges[:, :-1]) / 2
+    nodes, weights = np.polynomial.legendre.leggauss(n_gauss)
+    theta = middle[..., np.newaxis] + half[..., np.newaxis] * nodes  # (lines, pieces, n_gauss)
+    detuning = delta[:, np.newaxis, np.newaxis] + amplitude * np.sin(theta)
+    lorentz = (gamma / 2) ** 2 / (detuning ** 2 + (gamma / 2) ** 2)
+    rate = np.where(np.abs(detuning) > cutoff, 0, np.minimum(scale[:, np.newaxis, np.newaxis] * lorentz, A21))
+    average = np.sum(half * np.sum(weights * rate, axis=-1), axis=-1) / np.pi
+    if per_power is None:
+        return average
+
+    # the rate only depends on the power and frequency where it is inside the cutoff and not saturated
+    smooth = (np.abs(detuning) <= cutoff) & (scale[:, np.newaxis, np.newaxis] * lorentz < A21)
+    d_power = np.where(smooth, per_power[:, np.newaxis, np.newaxis] * lorentz, 0)
+    d_freq = np.where(smooth, -2 * scale[:, np.newaxis, np.newaxis] * detuning * lorentz ** 2 / (gamma / 2) ** 2, 0)
+    d_power = np.sum(half * np.sum(weights * d_power, axis=-1), axis=-1) / np.pi
+    d_freq = np.sum(half * np.sum(weights * d_freq, axis=-1), axis=-1) / np.pi
+    # the rate jumps to 0 at the cutoffs, so moving the line also moves the phases where the jitter crosses them. the
+    # phase of the crossing of detuning c moves by 1 / sqrt(amplitude**2 - (c - delta)**2) per Hz
+    for c, jump in ((cutoff, -1), (-cutoff, 1)):
+        distance = np.abs(c - delta)
+        crossed = distance < amplitude
+        rate_c = np.minimum(scale * (gamma / 2) ** 2 / (c ** 2 + (gamma / 2) ** 2), A21)
+        speed = 1 / np.sqrt(np.where(crossed, amplitude ** 2 - distance ** 2, 1))
+        d_freq = d_freq + np.where(crossed, jump * rate_c * speed, 0) / np.pi
+    return average, d_power, d_freq
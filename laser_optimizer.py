@@ -0,0 +1,124 @@
+import numpy as np
+import beam_spectrum as spec
+import Graphing_txt_resonator as Mod
+import jitter_average
+import OP_graph_model as model
+from state_registry import registry
+
+# finds the laser settings that pump the most atoms into |2, 2), using the gradient of the result with respect to the
+# settings instead of trying values by hand. the gradient is calculated in two steps, both exact:
+#     1. the rate table. every rate is a sum over the lines of the spectrum of the jitter averaged Lorentzian of
+#        Band.cross_sect, so its derivative is the sum of (d rate / d line power) * (d line power / d setting) and
+#        (d rate / d line frequency) * (d line frequency / d setting). jitter_average.line_derivatives differentiates
+#        the average of each line, and line_jacobian below gives how the settings move the lines: mod800 and dBm80
+#        change the powers of the side bands (through SidebandModel.slopes), lone_power the power of the lone band,
+#        and detuning the frequency of every line. polar_frac only scales the rates (polarization_weights)
+#     2. the populations. v(t_end) = expm(M t_end) v0, and M depends linearly on the rates. the derivative of the
+#        matrix exponential comes from the block matrix expm([[M, dM], [0, M]] t_end), whose top right block is
+#        d expm(M t_end) (Van Loan), one 32x32 expm per setting
+# so one step of the optimizer costs about one evaluation of the model. the rates are always averaged over the
+# jitter with the 'analytic' method (the default of LaserConfig), whatever config.jitter_method is.
+# the settings are scaled to 0 to 1 between their bounds, so L-BFGS-B sees them all with the same size
+
+parameters = ['mod800', 'dBm80', 'lone_power', 'polar_frac', 'detuning']  # the settings that can be optimized
+bounds = {'mod800': (0, 0.5),  # at most all the power in the two 800 MHz side bands
+          'dBm80': (-25, -9),  # the range of the resonator data
+          'lone_power': (0, 40),
+          'polar_frac': (0.9, 1),
+          'detuning': (-50 * 10 ** 6, 50 * 10 ** 6)}  # Hz
+
+# what is maximized: the initial populations and the states whose total percent at t_end is the result, the same
+# numbers as parameter_sweep.result_names
+targets = {'efficiency': (model.v_input, ['|2, 2)']),
+           'ring_survival': (model.v_ring, ['|2, 2)']),
+           'ring_survival_21_22': (model.v_ring, ['|2, 1)', '|2, 2)'])}
+
+
+def line_jacobian(config, names=parameters):
+    # the derivatives of the power and the frequency (Hz) of every line of spec.build_spectrum(config) with respect
+    # to each setting in names. returns two arrays of shape (number of lines, len(names))
+    orders = np.abs(np.arange(-config.eom_orders, config.eom_orders + 1))
+    strengths = Mod.sideband_model().strengths(config.dBm80, range(config.eom_orders + 1))[orders]
+    slopes = Mod.sideband_model().slopes(config.dBm80, range(config.eom_orders + 1))[orders]
+    fractions = [config.mod800, 1 - 2 * config.mod800, config.mod800]  # the three Band800s of the Beam
+    n_lines = 3 * len(orders) + 1  # the lone band is the last line
+    lines = {'mod800': (np.concatenate([config.beam_power * d * strengths for d in (1, -2, 1)] + [[0]]), 0),
+             'dBm80': (np.concatenate([config.beam_power * fraction * slopes for fraction in fractions] + [[0]]), 0),
+             'lone_power': (np.eye(n_lines)[-1], 0),
+             'polar_frac': (0, 0),
+             'detuning': (0, 1)}
+    d_power = np.zeros((n_lines, len(names)))
+    d_freq = np.zeros((n_lines, len(names)))
+    for k, name in enumerate(names):
+        d_power[:, k], d_freq[:, k] = lines[name]
+    return d_power, d_freq
+
+
+def rate_sensitivities(config=spec.default_config, names=parameters):
+    # the number of photons absorbed in 1 cm for every transition (like spec.rate_table), and its derivative with
+    # respect to each setting in names, shape (len(names), number of transitions)
+    spectrum = spec.build_spectrum(config)
+    average, d_power, d_freq = jitter_average.line_derivatives(spectrum, config.main_freq + spec.t_freqs * 10 ** 6,
+                                                               config.jitter_amp)
+    line_power, line_freq = line_jacobian(config, names)
+    weights = registry.polarization_weights(config.polar_frac) * registry.t_strength / 20000
+    nums = average.sum(axis=-1) * weights
+    d_nums = (d_power @ line_power + d_freq @ line_freq).T * weights
+    if 'polar_frac' in names:  # polar_frac for +sigma, (1 - polar_frac) / 2 for the others, halved again for pi
+        d_weights = np.where(registry.sigma_plus, 1, -1 / 2) * np.where(registry.pi, 1 / 2, 1)
+        d_nums[names.index('polar_frac')] = average.sum(axis=-1) * d_weights * registry.t_strength / 20000
+    return nums, d_nums
+
+
+def objective(config=spec.default_config, target='efficiency', names=parameters, t_end=model.t_end):
+    # the result [target] (percent) for the settings in config, and its gradient with respect to names
+    from scipy.linalg import expm
+    v0, states = targets[target]
+    nums, d_nums = rate_sensitivities(config, names)
+    M = registry.absorption_matrix(nums * 20000) + model.emission_matrix()
+    dM = registry.absorption_matrix(d_nums * 20000)  # the absorption matrix is linear in the rates
+    n = len(M)
+    block = np.zeros((len(names), 2 * n, 2 * n))
+    block[:, :n, :n] = M
+    block[:, n:, n:] = M
+    block[:, :n, n:] = dM
+    step = expm(block * t_end) if len(names) else expm(M * t_end)[np.newaxis]
+    v = step[0, :n, :n] @ v0
+    dv = step[:, :n, n:] @ v0  # (len(names), 16)
+    index = [registry.index[state] for state in states]
+    return v[index].sum(), dv[:, index].sum(axis=-1)
+
+
+def optimize(config=spec.default_config, names=parameters, target='efficiency', limits=None, **options):
+    # maximizes [target] over the settings in names with L-BFGS-B, starting from config. limits changes the default
+    # bounds, e.g. limits={'dBm80': (-20, -10)}. options are passed to scipy.optimize.minimize (like maxiter). returns
+    # the result of minimize, with .config the best LaserConfig and .value the best result (percent)
+    from scipy.optimize import minimize
+    names = list(names)
+    limits = dict(bounds, **(limits or {}))
+    low = np.array([limits[name][0] for name in names], dtype=float)
+    high = np.array([limits[name][1] for name in names], dtype=float)
+
+    def settings(x):
+        return config._replace(**{name: float(value) for name, value in zip(names, low + x * (high - low))})
+
+    def negative(x):
+        value, gradient = objective(settings(x), target, names)
+        return -value, -gradient * (high - low)
+
+    x0 = np.clip((np.array([getattr(config, name) for name in names], dtype=float) - low) / (high - low), 0, 1)
+    result = minimize(negative, x0, jac=True, method='L-BFGS-B', bounds=[(0, 1)] * len(names), options=options)
+    result.config = settings(result.x)
+    result.value = -result.fun
+    return result
+
+
+if __name__ == '__main__':
+    start = objective()[0]
+    result = optimize()
+    print('percent in |2, 2) after initial input with the default settings: ', start)
+    print('percent in |2, 2) after initial input with the best settings: ', result.value)
+    for name in parameters:
+        print(name, '=', getattr(result.config, name))
+    print('percent in |2, 2) from OP_graph_model with the best settings: ',
+          model.solve_pumping(result.config)[0].y[4, -1])
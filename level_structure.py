@@ -0,0 +1,228 @@
+import math
+from fractions import Fraction
+import numpy as np
+import beam_class
+import beam_spectrum as spec
+import OP_graph_model as model
+import state_data
+from state_registry import StateRegistry
+
+# state_data has the 8 ground and 8 excited states of the Li 7 D1 line at B = 145 G typed in by hand. this module
+# calculates the same kind of data for Li 6 or Li 7, the D1 or D2 line, and any magnetic field:
+#     - the energies come from diagonalizing the hyperfine + Zeeman Hamiltonian
+#           H = A I.J + B_q (3 (I.J)**2 + 3/2 I.J - I(I+1)J(J+1)) / (2I(2I-1)J(2J-1)) + mu_B B (g_J J_z + g_I I_z)
+#       in the |m_J, m_I) basis (the Breit-Rabi problem). m_F = m_J + m_I does not change, so each m_F block is
+#       diagonalized on its own, and since levels with the same m_F never cross, the eigenvalues of a block (sorted)
+#       keep the order of the B = 0 hyperfine levels, which gives their (F, m_F) labels
+#     - the relative strengths come from the electric dipole matrix elements between the eigenvectors. the dipole
+#       only acts on the electron, so (e|d_q|g) = sum over m_I of e(m_J', m_I) g(m_J, m_I) (J m_J 1 q|J' m_J') with a
+#       Clebsch-Gordan coefficient. the squares add up to 1 for every excited state, so they are the emission
+#       branching ratios directly, like state_data.emit_str
+# the energies use the same references as state_data: ground states relative to the B = 0, F_g = I - 1/2 level and
+# excited states relative to the B = 0, F_e = I + J' level (for Li 7 D1 that is F_g = 1 and F_e = 2, so main_freq is
+# still the B = 0 F_g = 1 -> F_e = 2 transition). every level structure has a StateRegistry, and its generator can
+# be built as a scipy.sparse CSR matrix whose size grows with the number of transitions, not states**2
+
+mu_B = 1.399624604  # MHz / G, Bohr magneton
+
+# the hyperfine constants (MHz) and g factors, from Arimondo, Inguscio and Violino, Rev. Mod. Phys. 49, 31 (1977)
+# and Gehm, Properties of 6Li (2003). g_I is in units of mu_B, with the sign convention of H above
+isotopes = {'Li7': {'I': 3 / 2, 'g_I': -0.0011822130,
+                    'S1/2': {'J': 1 / 2, 'A': 401.7520433, 'B': 0, 'g_J': 2.0023010},
+                    'P1/2': {'J': 1 / 2, 'A': 45.914, 'B': 0, 'g_J': 0.6668},
+                    'P3/2': {'J': 3 / 2, 'A': -3.055, 'B': -0.221, 'g_J': 1.335}},
+            'Li6': {'I': 1, 'g_I': -0.0004476540,
+                    'S1/2': {'J': 1 / 2, 'A': 152.1368407, 'B': 0, 'g_J': 2.0023010},
+                    'P1/2': {'J': 1 / 2, 'A': 17.386, 'B': 0, 'g_J': 0.6668},
+                    'P3/2': {'J': 3 / 2, 'A': -1.155, 'B': -0.10, 'g_J': 1.335}}}
+lines = {'D1': 'P1/2', 'D2': 'P3/2'}  # the excited term of each line, the ground term is always S1/2
+
+
+def spin_matrices(j):  # J_z, J_+ and J_- for spin j, in the basis m = -j ... j
+    m = np.arange(-j, j + 1)
+    raising = np.diag(np.sqrt(j * (j + 1) - m[:-1] * (m[:-1] + 1)), -1)  # (m + 1|J_+|m) is below the diagonal
+    return np.diag(m), raising, raising.T
+
+
+def clebsch_gordan(j1, m1, j2, m2, j, m):  # (j1 m1 j2 m2|j m), with the Racah formula
+    if abs(m1 + m2 - m) > 10 ** -9 or abs(m1) > j1 or abs(m2) > j2 or abs(m) > j or not abs(j1 - j2) <= j <= j1 + j2:
+        return 0.0
+    f = [round(x) for x in (j1 + j2 - j, j1 - j2 + j, -j1 + j2 + j, j1 + j2 + j + 1, j1 + m1, j1 - m1,
+                            j2 + m2, j2 - m2, j + m, j - m)]
+    factor = math.sqrt((2 * j + 1) * math.factorial(f[0]) * math.factorial(f[1]) * math.factorial(f[2]) /
+                       math.factorial(f[3]) * math.factorial(f[4]) * math.factorial(f[5]) * math.factorial(f[6]) *
+                       math.factorial(f[7]) * math.factorial(f[8]) * math.factorial(f[9]))
+    total = 0.0
+    for k in range(0, f[0] + 1):
+        terms = [f[0] - k, f[5] - k, f[6] - k, round(j - j2 + m1) + k, round(j - j1 - m2) + k]
+        if min(terms) < 0:
+            continue
+        denominator = math.factorial(k)
+        for i in terms:
+            denominator = denominator * math.factorial(i)
+        total = total + (-1) ** k / denominator
+    return factor * total
+
+
+def hamiltonian(I, g_I, J, A, B_q, g_J, field):  # the Hamiltonian H above (MHz) in the |m_J, m_I) basis
+    J_z, J_up, J_down = spin_matrices(J)
+    I_z, I_up, I_down = spin_matrices(I)
+    IJ = np.kron(J_z, I_z) + (np.kron(J_up, I_down) + np.kron(J_down, I_up)) / 2
+    H = A * IJ + mu_B * field * (g_J * np.kron(J_z, np.eye(len(I_z))) + g_I * np.kron(np.eye(len(J_z)), I_z))
+    if B_q != 0 and I > 1 / 2 and J > 1 / 2:
+        H = H + B_q * (3 * IJ @ IJ + 1.5 * IJ - I * (I + 1) * J * (J + 1) * np.eye(len(IJ))) / (
+            2 * I * (2 * I - 1) * J * (2 * J - 1))
+    return H
+
+
+def zero_field_energy(I, J, A, B_q, F):  # the B = 0 energy (MHz) of the hyperfine level F
+    K = F * (F + 1) - I * (I + 1) - J * (J + 1)
+    energy = A * K / 2
+    if B_q != 0 and I > 1 / 2 and J > 1 / 2:
+        energy = energy + B_q * (1.5 * K * (K + 1) - 2 * I * (I + 1) * J * (J + 1)) / (
+            4 * I * (2 * I - 1) * J * (2 * J - 1))
+    return energy
+
+
+def hyperfine_scan(isotope, term, fields):
+    # the states of one term ('S1/2', 'P1/2' or 'P3/2') for every magnetic field (G) in [fields] at once, each m_F
+    # block is diagonalized as a stack over the fields. returns the list of (F, m_F) of the states, F from high to
+    # low and m_F from low to high like state_data, their energies (MHz, relative to the B = 0 reference level) with
+    # shape (len(fields), n_states), and their eigenvectors in the |m_J, m_I) basis, shape (len(fields), n_states, n)
+    data = isotopes[isotope]
+    I, g_I = data['I'], data['g_I']
+    J, A, B_q, g_J = data[term]['J'], data[term]['A'], data[term]['B'], data[term]['g_J']
+    fields = np.atleast_1d(np.asarray(fields, dtype=float))
+    H_0 = hamiltonian(I, g_I, J, A, B_q, g_J, 0)
+    H = H_0 + fields[:, np.newaxis, np.newaxis] * (hamiltonian(I, g_I, J, A, B_q, g_J, 1) - H_0)
+    m_F = (np.arange(-J, J + 1)[:, np.newaxis] + np.arange(-I, I + 1)).ravel()  # m_J + m_I of each basis state
+    F_values = np.arange(abs(I - J), I + J + 1)
+    reference = zero_field_energy(I, J, A, B_q, I - 1 / 2 if term == 'S1/2' else I + J)
+    states, energies, vectors = [], [], []
+    for m in np.unique(m_F):
+        block = np.nonzero(np.abs(m_F - m) < 10 ** -9)[0]
+        w, V = np.linalg.eigh(H[:, block[:, np.newaxis], block])
+        F_block = [F for F in F_values if F >= abs(m)]
+        F_block = sorted(F_block, key=lambda F: zero_field_energy(I, J, A, B_q, F))  # the order of the levels
+        for k, F in enumerate(F_block):
+            vector = np.zeros((len(fields), len(H_0)))
+            vector[:, block] = V[:, :, k]
+            states.append((F, m))
+            energies.append(w[:, k] - reference)
+            vectors.append(vector)
+    order = sorted(range(len(states)), key=lambda i: (-states[i][0], states[i][1]))
+    return ([states[i] for i in order], np.stack([energies[i] for i in order], axis=-1),
+            np.stack([vectors[i] for i in order], axis=1))
+
+
+def hyperfine_levels(isotope, term, field):
+    # the states of one term at the magnetic field [field] (G), as a list of (F, m_F, energy, eigenvector), see
+    # hyperfine_scan
+    states, energies, vectors = hyperfine_scan(isotope, term, [field])
+    return [(F, m, energies[0, i], vectors[0, i]) for i, (F, m) in enumerate(states)]
+
+
+def dipole_matrix(isotope, line):
+    # the dipole matrix (J' m_J', m_I|d_q|J m_J, m_I) between the excited and ground |m_J, m_I) basis states, for the
+    # q = m_J' - m_J that connects them
+    J_g = isotopes[isotope]['S1/2']['J']
+    J_e = isotopes[isotope][lines[line]]['J']
+    n_I = int(round(2 * isotopes[isotope]['I'])) + 1
+    m_J_g = np.repeat(np.arange(-J_g, J_g + 1), n_I)  # m_J of each |m_J, m_I) basis state
+    m_J_e = np.repeat(np.arange(-J_e, J_e + 1), n_I)
+    m_I_g = np.tile(np.arange(n_I), len(m_J_g) // n_I)
+    m_I_e = np.tile(np.arange(n_I), len(m_J_e) // n_I)
+    return np.array([[clebsch_gordan(J_g, m_J_g[b], 1, m_J_e[a] - m_J_g[b], J_e, m_J_e[a])
+                      if m_I_e[a] == m_I_g[b] else 0 for b in range(len(m_J_g))] for a in range(len(m_J_e))])
+
+
+def label(F, m_F, excited=False):  # '|2,-1)', '|2, 0)', 'e|3/2, 1/2)', like state_data
+    def number(x):
+        return str(Fraction(x).limit_denominator(2))
+    return ('e' if excited else '') + '|' + number(F) + ',' + ('' if m_F < 0 else ' ') + number(m_F) + ')'
+
+
+class LevelStructure:
+    def __init__(self, energy_g, energy_e, allowed_transitions, emit_str, abs_str=None, name=''):
+        # the same dictionaries as state_data, and the StateRegistry compiled from them
+        self.name = name
+        self.energy_g = energy_g
+        self.energy_e = energy_e
+        self.allowed_transitions = allowed_transitions
+        self.emit_str = emit_str
+        self.abs_str = abs_str
+        self.registry = StateRegistry(energy_g, energy_e, allowed_transitions, emit_str, abs_str)
+
+    def __repr__(self):
+        return ('LevelStructure(' + repr(self.name) + ', ' + str(len(self.energy_g)) + ' ground, ' +
+                str(len(self.energy_e)) + ' excited, ' + str(len(self.registry.transitions)) + ' transitions)')
+
+
+def build(isotope='Li7', line='D1', field=145, threshold=10 ** -12):
+    # the LevelStructure of [isotope] ('Li7' or 'Li6') on [line] ('D1' or 'D2') at [field] (G). transitions with a
+    # relative strength below threshold are left out
+    ground = hyperfine_levels(isotope, 'S1/2', field)
+    excited = hyperfine_levels(isotope, lines[line], field)
+    dipole = dipole_matrix(isotope, line)
+    g_vectors = np.array([level[3] for level in ground])
+    e_vectors = np.array([level[3] for level in excited])
+    strengths = (e_vectors @ dipole @ g_vectors.T) ** 2  # (excited, ground), each row adds up to 1
+
+    g_labels = [label(F, m) for F, m, energy, vector in ground]
+    e_labels = [label(F, m, True) for F, m, energy, vector in excited]
+    energy_g = {state: float(level[2]) for state, level in zip(g_labels, ground)}
+    energy_e = {state: float(level[2]) for state, level in zip(e_labels, excited)}
+    emit_str = {e_state: {g_state: float(strengths[i, j]) for j, g_state in enumerate(g_labels)
+                          if strengths[i, j] > threshold} for i, e_state in enumerate(e_labels)}
+    allowed_transitions = {g_state: {e_state: 0 for i, e_state in enumerate(e_labels) if strengths[i, j] > threshold}
+                           for j, g_state in enumerate(g_labels)}
+    return LevelStructure(energy_g, energy_e, allowed_transitions, emit_str,
+                          name=isotope + ' ' + line + ' ' + str(field) + ' G')
+
+
+presets = {'state_data': lambda: LevelStructure(state_data.energy_g, state_data.energy_e,
+                                                state_data.allowed_transitions, state_data.emit_str,
+                                                state_data.abs_str, name='Li7 D1 145 G (state_data)'),
+           'Li7 D1': lambda: build('Li7', 'D1'),
+           'Li7 D2': lambda: build('Li7', 'D2'),
+           'Li6 D1': lambda: build('Li6', 'D1'),
+           'Li6 D2': lambda: build('Li6', 'D2')}
+
+
+def preset(name='state_data'):  # one of the level structures in presets, state_data is the one the model uses
+    return presets[name]()
+
+
+def rate_table(config=spec.default_config, structure=None):
+    # the number of photons absorbed in 1 cm for every transition of structure (a LevelStructure, state_data if None)
+    # in the order of structure.registry.transitions, like beam_spectrum.rate_table (but not cached)
+    if structure is None:
+        return spec.rate_table(config)
+    return spec.photon_numbers(config, structure.registry)
+
+
+def sparse_generator(config=spec.default_config, structure=None):
+    # the generator M of the rate equations for structure as a scipy.sparse CSR matrix
+    registry = preset().registry if structure is None else structure.registry
+    return registry.sparse_generator(rate_table(config, structure) * 20000, beam_class.A21)
+
+
+def dense_generator(config=spec.default_config, structure=None):
+    # the generator M as a dense matrix, for OP_graph_model.propagate. for state_data (structure None) it is the
+    # cached OP_graph_model.generator
+    if structure is None:
+        return model.generator(config)
+    registry = structure.registry
+    return registry.absorption_matrix(rate_table(config, structure) * 20000) + registry.emission_matrix(beam_class.A21)
+
+
+if __name__ == '__main__':
+    for name in presets:
+        structure = preset(name)
+        M = sparse_generator(structure=structure)
+        v0 = np.zeros(structure.registry.n_states)
+        v0[0] = 100  # all atoms in the first ground state, |F_max, -F_max)
+        result = model.solve_rates(M, v0, model.t_eval)
+        best = np.argmax(result.y[:, -1])
+        print(structure, ': ', M.nnz, 'nonzero entries in the generator,', result.y[best, -1], 'percent in',
+              structure.registry.labels[best], 'after 1 cm')
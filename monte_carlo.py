@@ -0,0 +1,160 @@
+import numpy as np
+import beam_spectrum as spec
+import level_structure
+import OP_graph_model as model
+import parameter_sweep
+
+# the rate equations give the mean populations, this module follows single atoms instead. the generator M of the rate
+# equations is also the generator of a continuous time Markov chain: an atom in state j jumps to state i with the
+# rate M[i, j], so it stays in j for an exponentially distributed time with the rate -M[j, j] and then picks where to
+# go with the probabilities M[i, j] / -M[j, j]. for the ground states these are the absorption rates of the rate
+# table, for the excited states A21 times the emit_str branching ratios (the model has no stimulated emission)
+# the jumps are sampled exactly (the Gillespie algorithm) for many atoms at once: every step draws the next jump of
+# every atom that is still in the beam with a few numpy calls, so the python loop only runs once per jump of the atom
+# with the most jumps. atoms in a dark state (no way out) finish at once
+# the results are per atom (number of photons absorbed and emitted, time in each state) and the number of atoms in
+# each state at the given times. averaged over the atoms they converge to the rate equations (see expected) with an
+# error of about 1 / sqrt(n_atoms)
+
+
+def jump_tables(M):
+    # the total rate out of every state, and the cumulative probabilities of where it jumps to, shape (n, n) with
+    # [j] the cumulative probabilities of the states after a jump out of j
+    M = np.asarray(M, dtype=float)
+    out_rates = -np.diagonal(M).copy()
+    jumps = M.T.copy()
+    np.fill_diagonal(jumps, 0)
+    cumulative = np.cumsum(jumps, axis=1)
+    totals = cumulative[:, -1:]
+    cumulative = np.divide(cumulative, totals, out=np.ones_like(cumulative), where=totals > 0)
+    return out_rates, cumulative
+
+
+def simulate(M, v0=model.v_input, n_atoms=10000, t_end=model.t_end, times=None, rng=None,
+             n_ground=model.registry.n_ground):
+    # samples the jumps of n_atoms atoms for the generator M, from 0 to t_end. the initial state of every atom is drawn
+    # from v0 (the populations in percent, like the rate equations), and the first n_ground states are the ground
+    # states (a jump out of them absorbs a photon, a jump out of the others emits one). rng is a numpy Generator or a
+    # seed. returns a result with
+    #     .absorbed, .emitted   the number of photons each atom absorbed and emitted, shape (n_atoms,)
+    #     .histogram            the number of atoms that emitted (scattered) 0, 1, 2, ... photons
+    #     .dwell                the time (s) each atom spent in each state, shape (n_atoms, n_states)
+    #     .jumps                the number of jumps from state j to state i in [i, j] over all atoms
+    #     .populations          the percent of atoms in each state at the times in .t, shape (n_states, len(times)),
+    #                           like the .y of OP_graph_model.solve_rates
+    from scipy.optimize import OptimizeResult
+    rng = np.random.default_rng(rng)
+    M = np.asarray(M, dtype=float)
+    n = len(M)
+    times = np.linspace(0, t_end, 51) if times is None else np.asarray(times, dtype=float)
+    out_rates, cumulative = jump_tables(M)
+    v0 = np.asarray(v0, dtype=float)
+
+    state = rng.choice(n, size=n_atoms, p=v0 / v0.sum())
+    time = np.zeros(n_atoms)
+    absorbed = np.zeros(n_atoms, dtype=int)
+    emitted = np.zeros(n_atoms, dtype=int)
+    dwell = np.zeros((n_atoms, n))
+    jumps = np.zeros(n * n, dtype=int)
+    counts = np.zeros(n * (len(times) + 1), dtype=int)  # difference array of the atoms in each state at each time
+    atoms = np.arange(n_atoms)
+    while len(atoms):
+        s = state[atoms]
+        rate = out_rates[s]
+        with np.errstate(divide='ignore'):
+            wait = -np.log(1 - rng.random(len(atoms))) / rate  # inf in a dark state
+        start = time[atoms]
+        end = np.minimum(start + wait, t_end)
+        dwell[atoms, s] += end - start
+        # the atom is in s at the sample times in [start, end), or until the last one if it stays to the end
+        first = np.searchsorted(times, start, side='left')
+        last = np.where(start + wait < t_end, np.searchsorted(times, end, side='left'), len(times))
+        counts += np.bincount(s * (len(times) + 1) + first, minlength=len(counts))
+        counts -= np.bincount(s * (len(times) + 1) + last, minlength=len(counts))
+
+        jumping = start + wait < t_end
+        atoms = atoms[jumping]
+        s = s[jumping]
+        u = 1 - rng.random(len(atoms))  # in (0, 1]
+        new = (cumulative[s] < u[:, np.newaxis]).sum(axis=1)
+        time[atoms] = end[jumping]
+        state[atoms] = new
+        jumps += np.bincount(new * n + s, minlength=n * n)
+        emitting = s >= n_ground
+        emitted[atoms[emitting]] += 1
+        absorbed[atoms[~emitting]] += 1
+
+    populations = np.cumsum(counts.reshape(n, len(times) + 1), axis=1)[:, :-1] * 100 / n_atoms
+    return OptimizeResult(t=times, populations=populations, absorbed=absorbed, emitted=emitted,
+                          histogram=np.bincount(emitted), dwell=dwell, jumps=jumps.reshape(n, n), n_atoms=n_atoms)
+
+
+def expected(M, v0=model.v_input, t_end=model.t_end, n_ground=model.registry.n_ground):
+    # what simulate converges to, from the rate equations: the mean time in each state is the integral of v(t) / 100
+    # from 0 to t_end, which is the last column of the exponential of the block matrix [[M, v0], [0, 0]] t_end. the
+    # mean number of jumps from j to i is M[i, j] times the time in j
+    from scipy.linalg import expm
+    from scipy.optimize import OptimizeResult
+    M = np.asarray(M, dtype=float)
+    n = len(M)
+    block = np.zeros((n + 1, n + 1))
+    block[:n, :n] = M
+    block[:n, n] = np.asarray(v0, dtype=float) / 100
+    dwell = expm(block * t_end)[:n, n]
+    jumps = M * dwell
+    np.fill_diagonal(jumps, 0)
+    return OptimizeResult(dwell=dwell, jumps=jumps, absorbed=jumps[:, :n_ground].sum(),
+                          emitted=jumps[:, n_ground:].sum())
+
+
+def _simulate_task(task):  # simulate for the process pool, which passes one argument
+    return simulate(*task)
+
+
+def sample(config=spec.default_config, structure=None, v0=model.v_input, n_atoms=100000, t_end=model.t_end,
+           times=None, seed=None, workers=1, chunk=100000):
+    # simulate for the laser settings in config, split into chunks of at most [chunk] atoms (to bound the memory) that
+    # run in [workers] processes (see parameter_sweep.pool_map). structure is a level_structure.LevelStructure, or
+    # state_data if None. every chunk gets its own random stream from seed, so the result only depends on seed and
+    # chunk, not on workers. returns the result of simulate for all the atoms, with .expected (see expected)
+    M = level_structure.dense_generator(config, structure)
+    n_ground = (model.registry if structure is None else structure.registry).n_ground
+    times = np.linspace(0, t_end, 51) if times is None else np.asarray(times, dtype=float)
+    sizes = [min(chunk, n_atoms - i) for i in range(0, n_atoms, chunk)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(M, v0, size, t_end, times, np.random.default_rng(stream), n_ground)
+             for size, stream in zip(sizes, streams)]
+    results = parameter_sweep.pool_map(_simulate_task, tasks, workers)
+
+    result = results[0]
+    if len(results) > 1:
+        for name in ('absorbed', 'emitted', 'dwell'):
+            result[name] = np.concatenate([i[name] for i in results])
+        result.jumps = sum(i.jumps for i in results)
+        result.populations = sum(i.populations * i.n_atoms for i in results) / n_atoms
+        result.histogram = np.bincount(result.emitted)
+        result.n_atoms = n_atoms
+    result.expected = expected(M, v0, t_end, n_ground)
+    return result
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    import time
+    start = time.perf_counter()
+    mc = sample(n_atoms=100000, seed=1)
+    print('100000 atoms in', round(time.perf_counter() - start, 2), 's')
+    mean_dwell = mc.dwell.mean(axis=0)
+    print('photons emitted per atom: ', mc.emitted.mean(), '+-', mc.emitted.std() / np.sqrt(mc.n_atoms),
+          ' rate equations:', mc.expected.emitted)
+    print('photons absorbed per atom:', mc.absorbed.mean(), ' rate equations:', mc.expected.absorbed)
+    print('percent in |2, 2) at the end:', mc.populations[4, -1], ' rate equations:',
+          model.solve_pumping()[0].y[4, -1])
+    print('largest difference in the time in each state (us):',
+          np.abs(mean_dwell - mc.expected.dwell).max() * 10 ** 6)
+
+    plt.bar(np.arange(len(mc.histogram)), mc.histogram / mc.n_atoms)
+    plt.title('Number of photons scattered per atom in 1 cm of optical pumping')
+    plt.xlabel('Photons')
+    plt.ylabel('Fraction of atoms')
+    plt.show()
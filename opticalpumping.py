@@ -0,0 +1,212 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from functools import lru_cache
+import numpy as np
+import beam_spectrum as spec
+import level_structure
+import OP_graph_model as model
+import parameter_sweep
+import trajectory_store
+
+# the command line entry point for batch runs, e.g. on a cluster:
+#     python -m opticalpumping run config.toml [--workers 8] [--output results] [--figures]
+#     python -m opticalpumping example > config.toml
+# the config file (TOML) has the sections below, every setting is optional (see example_config)
+#     [laser]   any LaserConfig setting (beam_spectrum), the rest keep their default values
+#     [levels]  preset = a name in level_structure.presets, or isotope, line and field for level_structure.build
+#     [solver]  method (OP_graph_model.solve_rates), t_end (s), n_times, initial and target (state labels)
+#     [sweep]   a list of values for any LaserConfig setting, every combination is run (parameter_sweep.grid)
+#     [output]  directory and figures, which the command line options override
+# the output directory gets config.json (the settings used), results.csv (one row per run: the swept settings, the
+# percent in the target state and the final populations of every state) and trajectories/ (a trajectory_store with
+# the populations of every run vs time). the figures are only made when asked for, by the plotting module with the
+# Agg backend, so a batch run never imports matplotlib
+
+sections = {'laser': spec.default_config._asdict(),
+            'levels': {'preset': 'state_data', 'isotope': None, 'line': 'D1', 'field': 145},
+            'solver': {'method': 'eig', 't_end': model.t_end, 'n_times': 51, 'initial': None, 'target': None},
+            'sweep': {},
+            'output': {'directory': 'results', 'figures': False}}
+
+example_config = '''# settings for python -m opticalpumping run, every one of them is optional
+
+[laser]  # any beam_spectrum.LaserConfig setting
+dBm80 = -14
+mod800 = 0.3
+polar_frac = 0.98
+
+[levels]  # a level_structure preset, or isotope ('Li7', 'Li6'), line ('D1', 'D2') and field (G) to build one
+preset = "state_data"
+# isotope = "Li7"
+# line = "D1"
+# field = 145
+
+[solver]
+method = "eig"  # 'eig', 'expm' or a solve_ivp method
+t_end = 5e-5  # s
+n_times = 51
+initial = "|2,-2)"  # all atoms start in this state (the first ground state if not given)
+target = "|2, 2)"  # the state the pumping efficiency is for (the highest F and m_F ground state if not given)
+
+[sweep]  # every combination of these laser settings is run
+# dBm80 = [-16, -14, -12]
+# mod800 = [0.2, 0.25, 0.3]
+
+[output]
+directory = "results"
+figures = false
+'''
+
+
+def load(path):  # the settings in the TOML file at path, with the defaults of sections for everything not given
+    import tomllib
+    with open(path, 'rb') as file:
+        data = tomllib.load(file)
+    settings = {}
+    for section, defaults in sections.items():
+        given = data.pop(section, {})
+        if not isinstance(given, dict):
+            raise ValueError('[' + section + '] has to be a table')
+        unknown = set(given) - set(spec.LaserConfig._fields if section == 'sweep' else defaults)
+        if unknown:
+            raise ValueError('unknown settings in [' + section + ']: ' + ', '.join(sorted(unknown)))
+        settings[section] = {**defaults, **given}
+    if data:
+        raise ValueError('unknown sections: ' + ', '.join(sorted(data)))
+    for name, values in settings['sweep'].items():
+        settings['sweep'][name] = values if isinstance(values, list) else [values]
+    return settings
+
+
+@lru_cache(maxsize=8)
+def structure(preset='state_data', isotope=None, line='D1', field=145):
+    # the LevelStructure of the [levels] settings. None for the state_data preset, which the model uses directly
+    if isotope is not None:
+        return level_structure.build(isotope, line, field)
+    if preset not in level_structure.presets:
+        raise ValueError('unknown level structure preset ' + repr(preset) + ', use one of ' +
+                         ', '.join(level_structure.presets))
+    return None if preset == 'state_data' else level_structure.preset(preset)
+
+
+def _states(levels):  # the StateRegistry of the [levels] settings
+    levels = structure(**levels)
+    return model.registry if levels is None else levels.registry
+
+
+def _state(states, label, default):  # the index of the state label, or default if label is None
+    if label is None:
+        return default
+    if label not in states.index:
+        raise ValueError('unknown state ' + repr(label) + ', the states are ' + ', '.join(states.labels))
+    return states.index[label]
+
+
+def run_point(config, levels, solver):
+    # solves the rate equations for one LaserConfig with the [levels] and [solver] settings, and returns the
+    # populations, shape (n_states, n_times)
+    states = _states(levels)
+    M = level_structure.dense_generator(config, structure(**levels))
+    v0 = np.zeros(states.n_states)
+    v0[_state(states, solver['initial'], 0)] = 100
+    times = np.linspace(0, solver['t_end'], solver['n_times'])
+    return model.solve_rates(M, v0, times, solver['method']).y
+
+
+def _run_task(task):  # run_point for the process pool, which passes one argument
+    return run_point(*task)
+
+
+def run(settings, workers=1):
+    # runs every point of the settings (from load) and returns the configs, the names of the swept settings, and the
+    # populations of every run, shape (n_points, n_states, n_times). workers is the number of processes (see
+    # parameter_sweep.pool_map)
+    states = _states(settings['levels'])
+    _state(states, settings['solver']['initial'], 0)  # checks the labels before anything is solved
+    _state(states, settings['solver']['target'], 0)
+    base = spec.default_config._replace(**settings['laser'])
+    swept = list(settings['sweep'])
+    if swept:
+        configs = [base._replace(**{name: getattr(config, name) for name in swept})
+                   for config in parameter_sweep.grid(**settings['sweep'])]
+    else:
+        configs = [base]
+    tasks = [(config, settings['levels'], settings['solver']) for config in configs]
+    y = parameter_sweep.pool_map(_run_task, tasks, workers)
+    return configs, swept, np.array(y)
+
+
+def write(directory, settings, configs, swept, y, figures=False):
+    # writes the output files described at the top into directory, and returns the results table (a structured
+    # array like parameter_sweep.sweep, also saved as results.csv)
+    states = _states(settings['levels'])
+    target_default = max(states.ground, key=lambda i: (states.F[i], states.m_F[i]))
+    target = _state(states, settings['solver']['target'], target_default)
+    times = np.linspace(0, settings['solver']['t_end'], settings['solver']['n_times'])
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'config.json'), 'w') as file:
+        json.dump(settings, file, indent=1)
+    with trajectory_store.TrajectoryWriter(os.path.join(directory, 'trajectories'), (len(configs),), times,
+                                           states.labels, configs) as writer:
+        writer.write(slice(None), y)
+
+    columns = swept + ['target'] + states.labels
+    table = np.zeros(len(configs), dtype=[(name, 'U16' if isinstance(getattr(configs[0], name), str) else float)
+                                          for name in swept] + [(name, float) for name in columns[len(swept):]])
+    for i, config in enumerate(configs):
+        table[i] = tuple(getattr(config, name) for name in swept) + (y[i, target, -1],) + tuple(y[i, :, -1])
+    with open(os.path.join(directory, 'results.csv'), 'w', newline='') as file:
+        results = csv.writer(file)
+        results.writerow(columns)
+        results.writerows(row.tolist() for row in table)
+
+    if figures:
+        import plotting
+        figure_directory = os.path.join(directory, 'figures')
+        os.makedirs(figure_directory, exist_ok=True)
+        for i in range(len(configs)):
+            plotting.populations_figure(times, y[i], states.labels, os.path.join(figure_directory,
+                                        'populations_' + str(i) + '.png'), states.n_ground)
+        if swept:
+            plotting.sweep_figure(table, swept, 'target', os.path.join(figure_directory, 'sweep.png'),
+                                  'Percent in ' + states.labels[target])
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m opticalpumping', description='batch runs of the optical '
+                                     'pumping model from a TOML config file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='solve the model for the settings in a config file')
+    run_parser.add_argument('config', help='the TOML config file')
+    run_parser.add_argument('--workers', type=int, default=1, help='number of processes for sweeps (0 for all the '
+                            'cores)')
+    run_parser.add_argument('--output', help='output directory, instead of [output] directory')
+    run_parser.add_argument('--figures', action=argparse.BooleanOptionalAction, default=None,
+                            help='save figures (with matplotlib), instead of [output] figures')
+    commands.add_parser('example', help='print an example config file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'example':
+        sys.stdout.write(example_config)
+        return 0
+    try:
+        settings = load(args.config)
+        directory = args.output if args.output is not None else settings['output']['directory']
+        figures = args.figures if args.figures is not None else settings['output']['figures']
+        configs, swept, y = run(settings, args.workers or None)
+        table = write(directory, settings, configs, swept, y, figures)
+    except (OSError, ValueError) as error:
+        parser.exit(1, parser.prog + ': error: ' + str(error) + '\n')
+    best = table[np.argmax(table['target'])]
+    print(len(table), 'run(s) written to', directory)
+    print('best percent in the target state:', best['target'],
+          *(name + ' = ' + str(best[name]) for name in swept))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
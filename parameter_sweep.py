@@ -0,0 +1,84 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import beam_spectrum as spec
+import instrumentation
+import OP_graph_model as model
+import ring_model
+
+# this module scans the laser settings. every point of a sweep is a beam_spectrum.LaserConfig, and for each one the
+# rates are calculated and the rate equations are solved (beam_spectrum -> OP_graph_model). the points are spread
+# over all the cores with a process pool, and the results come back as a numpy structured array with one row per
+# point: the settings, and the pumping efficiency, ring survival and number of cycles until half the atoms are lost
+
+# the columns added to the settings in the output of sweep
+result_names = ['efficiency',  # percent in |2, 2) after the initial input (starting in |2,-2))
+                'ring_survival',  # percent in |2, 2) after a cycle in the ring (starting in |2, 2))
+                'ring_survival_21_22',  # percent in |2, 1) and |2, 2) after a cycle in the ring
+                'half_life_cycles',  # number of cycles in the ring until half the atoms are lost
+                'ring_half_life_cycles']  # the same, keeping |2, 1) and |2, 2) from pass to pass (ring_model)
+
+
+def grid(**values):  # every combination of the given settings, e.g. grid(dBm80=[-16, -14], mod800=[0.2, 0.3])
+    names = list(values)
+    return [spec.default_config._replace(**dict(zip(names, combo))) for combo in itertools.product(*values.values())]
+
+
+def as_config(point):  # a sweep point can be a LaserConfig or a dictionary of the settings that are changed
+    if isinstance(point, spec.LaserConfig):
+        return point
+    return spec.default_config._replace(**point)
+
+
+@instrumentation.timed('sweep.evaluate')
+def evaluate(config):  # runs the whole pipeline for one config and returns the numbers in result_names
+    OP_model_input, OP_model_ring = model.solve_pumping(config)
+    efficiency = OP_model_input.y[4, -1]
+    survival = OP_model_ring.y[4, -1]
+    survival_21_22 = OP_model_ring.y[3, -1] + OP_model_ring.y[4, -1]
+    if survival >= 100:  # no atoms are lost (or round-off put survival just above 100)
+        half_life = np.inf
+    else:
+        with np.errstate(divide='ignore'):
+            half_life = np.log(1 / 2) / np.log(survival / 100)
+    return efficiency, survival, survival_21_22, half_life, ring_model.half_life(config)
+
+
+def pool_map(function, tasks, workers=None):
+    # [function(task) for task in tasks] in a pool of [workers] processes, os.cpu_count() if it is None. with
+    # workers=1 everything runs in this process, which is easier for debugging. function has to be a module level
+    # function, so it can be sent to the processes
+    tasks = list(tasks)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+    if workers == 1:
+        return [function(i) for i in tasks]
+    chunksize = max(1, len(tasks) // (workers * 4))  # a few chunks per process, to balance the load
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(function, tasks, chunksize=chunksize))
+
+
+def sweep(points, workers=None):
+    # points is a list of LaserConfigs or dictionaries (see grid). workers is the number of processes (see pool_map)
+    configs = [as_config(i) for i in points]
+    results = pool_map(evaluate, configs, workers)
+
+    dtype = [(name, 'U16' if isinstance(value, str) else float)
+             for name, value in spec.default_config._asdict().items()]
+    dtype = dtype + [(name, float) for name in result_names]
+    table = np.zeros(len(configs), dtype=dtype)
+    for i, (config, result) in enumerate(zip(configs, results)):
+        table[i] = tuple(config) + tuple(result)
+    return table
+
+
+if __name__ == '__main__':
+    # example: scan the rf power and the 800 MHz modulation, then print the best point
+    sweep_table = sweep(grid(dBm80=np.arange(-20, -9, 1.0), mod800=[0.2, 0.25, 0.3, 0.35]))
+    for row in sweep_table:
+        print('dBm80 =', row['dBm80'], ' mod800 =', row['mod800'], ' efficiency =', row['efficiency'],
+              ' cycles until half atoms lost =', row['half_life_cycles'])
+    best = sweep_table[np.argmax(sweep_table['efficiency'])]
+    print('best efficiency: ', best['efficiency'], 'at dBm80 =', best['dBm80'], 'and mod800 =', best['mod800'])
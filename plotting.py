@@ -0,0 +1,53 @@
+import numpy as np
+
+# the figures of the command line runs (see opticalpumping). matplotlib is only imported inside these functions, and
+# with the Agg backend, so the figures are written to files and nothing needs a display. the calculations never import
+# this module
+
+
+def _pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def populations_figure(t, y, labels, path, n_ground=None):
+    # the percent of atoms in each state vs time, ground states and excited states in two panels
+    plt = _pyplot()
+    n_ground = len(labels) // 2 if n_ground is None else n_ground
+    figure, axes = plt.subplots(1, 2, figsize=(12, 4.5))
+    for q in range(len(labels)):
+        axes[0 if q < n_ground else 1].plot(np.asarray(t) * 10 ** 6, y[q], label=labels[q])
+    for ax, title in zip(axes, ('ground states', 'excited states')):
+        ax.set_title('Percent of atoms in each ' + title + ' vs time')
+        ax.set_xlabel('Time (us)')
+        ax.set_ylabel('Percent')
+        ax.legend(fontsize='small')
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
+
+
+def sweep_figure(table, names, column, path, ylabel=None):
+    # [column] of the sweep table vs the first swept setting, one line for every value of the other settings
+    plt = _pyplot()
+    figure, ax = plt.subplots(figsize=(7, 4.5))
+    x = names[0]
+    others = names[1:]
+    groups = sorted(set(tuple(row[name] for name in others) for row in table))
+    for group in groups:
+        rows = table[np.all([table[name] == value for name, value in zip(others, group)] +
+                            [np.ones(len(table), dtype=bool)], axis=0)]
+        rows = np.sort(rows, order=x)
+        label = ', '.join(name + ' = ' + str(value) for name, value in zip(others, group))
+        ax.plot(rows[x], rows[column], marker='o', label=label or None)
+    ylabel = column if ylabel is None else ylabel
+    ax.set_title(ylabel + ' vs ' + x)
+    ax.set_xlabel(x)
+    ax.set_ylabel(ylabel)
+    if others:
+        ax.legend(fontsize='small')
+    figure.tight_layout()
+    figure.savefig(path)
+    plt.close(figure)
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import zipfile
+from collections import OrderedDict
+import numpy as np
+import Graphing_txt_resonator as Mod
+import instrumentation
+import state_data
+
+# this module remembers calculated rate tables (and generator matrices) so they are not calculated again. each entry
+# is a dictionary of numpy arrays, stored under a key that is a hash of everything the entry depends on: the laser
+# settings, the state data (energies, allowed transitions, emission strengths) and the resonator data. if any of
+# those change the key changes, so an old entry can never be used by mistake.
+# there are two levels: a small in-memory cache (least recently used entries are dropped first), and optionally a
+# directory on disk with one compressed .npz file per entry, so the tables survive restarts. the directory is set
+# with the environment variable OP_CACHE_DIR or with cache.set_directory(path), and is kept under max_bytes by
+# deleting the least recently used files
+
+version = 1  # change this when the way the rates are calculated changes, so old files on disk are not used
+
+
+def _plain(value):  # numpy numbers (e.g. from np.arange) as python numbers, which json can write
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {name: _plain(i) for name, i in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(i) for i in value]
+    return value
+
+
+def content_key(kind, config):
+    # the key of an entry. kind says what is stored (for example 'rates' or 'generator'), config is the settings (a
+    # beam_spectrum.LaserConfig, or a dictionary of settings). the settings are keyed by name, so adding or moving a
+    # LaserConfig field can not make an old key match
+    plot_vars, allpeaks = Mod.load_data()
+    settings = config._asdict() if hasattr(config, '_asdict') else config
+    inputs = [version, kind, _plain(settings), state_data.energy_g, state_data.energy_e,
+              state_data.allowed_transitions, state_data.emit_str, [i.tolist() for i in plot_vars]]
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class RateCache:
+    def __init__(self, directory=None, max_entries=256, max_bytes=100 * 2 ** 20):
+        self.directory = directory  # None means memory only
+        self.max_entries = max_entries  # entries kept in memory
+        self.max_bytes = max_bytes  # total size of the files on disk
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def set_directory(self, directory):  # turns the disk cache on (or off with None)
+        self.directory = directory
+
+    def get(self, key):  # returns the stored dictionary of arrays, or None
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits = self.hits + 1
+            instrumentation.count('cache.hits')
+            return self.memory[key]
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as npz:
+                    arrays = {name: npz[name] for name in npz.files}
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile):  # a broken file, e.g. cut short by a crash
+                self._remove(path)
+            else:
+                try:
+                    os.utime(path)  # the modification time is used to find the least recently used files
+                except OSError:  # another process removed it in the meantime, the arrays are already loaded
+                    pass
+                self._remember(key, arrays)
+                self.disk_hits = self.disk_hits + 1
+                instrumentation.count('cache.disk_hits')
+                return arrays
+        self.misses = self.misses + 1
+        instrumentation.count('cache.misses')
+        return None
+
+    def put(self, key, arrays):  # stores a dictionary of arrays, and returns it (as numpy arrays)
+        arrays = {name: np.asarray(value) for name, value in arrays.items()}
+        self._remember(key, arrays)
+        path = self._path(key)
+        if path is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            temp = path + '.' + str(os.getpid()) + '.tmp.npz'  # written under another name first, so other
+            np.savez_compressed(temp, **arrays)  # processes never read half a file
+            os.replace(temp, path)
+            self._evict_disk()
+        return arrays
+
+    def clear(self, disk=False):  # empties the memory cache, and the files too if disk is True
+        self.memory.clear()
+        if disk and self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    self._remove(os.path.join(self.directory, name))
+
+    def _remember(self, key, arrays):
+        self.memory[key] = arrays
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _path(self, key):
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, key + '.npz')
+
+    def _evict_disk(self):  # deletes the least recently used files until the directory is small enough
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # deleted by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total = total - size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:  # already deleted by another process
+            pass
+
+
+cache = RateCache(os.environ.get('OP_CACHE_DIR'))  # the cache used by beam_spectrum and OP_graph_model
+
+
+def cached(kind, config, compute):
+    # returns the entry for (kind, config) from the cache, or calls compute() (which returns a dictionary of arrays),
+    # stores the result and returns it. the arrays are shared, so do not change them in place
+    key = content_key(kind, config)
+    arrays = cache.get(key)
+    if arrays is None:
+        arrays = cache.put(key, compute())
+    return arrays
@@ -0,0 +1,142 @@
+import numpy as np
+import beam_spectrum as spec
+import OP_graph_model as model
+import rate_cache
+from state_registry import registry
+
+# OP_graph_model gets the number of cycles until half the atoms are lost from one pass starting in |2, 2), as
+# log(1/2) / log(p/100). that assumes the atoms that leave |2, 2) are lost at once, but atoms in |2, 1) are kept in the
+# ring too, and some of them are pumped back into |2, 2) in the next pass.
+# one pass through the optical pumping is a linear map of the ground state populations: the atoms are pumped for
+# t_end (v -> expm(M t_end) v), then the atoms still excited decay in the dark with the branching ratios of emit_str.
+# that map is an 8x8 matrix T (the transfer matrix), calculated once per config and kept in rate_cache. after each
+# pass the atoms in lost_states leave the ring, which sets those rows of T to 0 (the ring matrix R). the populations
+# after n passes are R^n v0, and with the eigendecomposition R = V diag(w) V^-1 every n is V diag(w^n) V^-1 v0, so
+# thousands of cycles take one small matrix product instead of thousands of solves
+
+ground_labels = registry.labels[:registry.n_ground]
+lost_states = ('|2,-2)', '|2,-1)', '|2, 0)', '|1,-1)', '|1, 0)', '|1, 1)')  # the states the ring does not keep
+v_ring = np.asarray(model.v_ring[:registry.n_ground], dtype=float)  # 100% of atoms in ground [2, 2)
+
+
+def dark_decay():
+    # (ground, excited) matrix of where the excited atoms end up after decaying: D[g, e] is the fraction of e|...)
+    # that decays into the ground state g
+    D = np.zeros((registry.n_ground, registry.n_states - registry.n_ground))
+    np.add.at(D, (registry.e_ground, registry.e_excited - registry.n_ground), registry.e_strength)
+    return D / D.sum(axis=0)
+
+
+def _transfer_matrix(config, t_pass, decay, method):  # kept in rate_cache, so do not change it in place
+    def compute():
+        ground = np.eye(registry.n_states)[:, :registry.n_ground]  # each ground state as a column
+        after = model.propagate(model._generator(config), ground.T, [t_pass], method)[..., 0].T  # (16, 8)
+        T = after[:registry.n_ground]
+        if decay:
+            T = T + dark_decay() @ after[registry.n_ground:]
+        return {'transfer': T}
+    return rate_cache.cached('transfer', dict(config._asdict(), t_pass=t_pass, decay=decay, method=method),
+                             compute)['transfer']
+
+
+def transfer_matrix(config=spec.default_config, t_pass=model.t_end, decay=True, method='eig'):
+    # the 8x8 matrix T of one pass: T[i, j] is the fraction of the atoms starting in ground state j that are in ground
+    # state i after the pass. with decay=False the atoms still excited at the end are dropped, like in OP_graph_model
+    return _transfer_matrix(config, t_pass, decay, method).copy()
+
+
+def ring_matrix(config=spec.default_config, lost=lost_states, **kwargs):
+    # the transfer matrix of one pass with the atoms in the states [lost] removed at the end of it
+    R = transfer_matrix(config, **kwargs)
+    R[[registry.index[state] for state in lost]] = 0
+    return R
+
+
+def power_function(R, v0):
+    # returns a function that gives R^n @ v0 for every n in an array of cycles (ints >= 0), shape (len(cycles), 8).
+    # it uses the eigendecomposition, which is only done once here, or np.linalg.matrix_power (repeated squaring) if
+    # the eigenvectors are badly conditioned. the eigenvalues that are 0 (from the lost states, up to round-off, which
+    # can make them slightly negative) only matter for n = 0, where the answer is v0, so they are left out. the log is
+    # taken as complex, since real negative eigenvalues are allowed (R^n then alternates in sign)
+    v0 = np.asarray(v0, dtype=float)
+    w, V = np.linalg.eig(R)
+    if np.linalg.cond(V, 1) >= 10 ** 8:
+        def powers(cycles):
+            cycles = np.asarray(cycles, dtype=int)
+            return np.array([np.linalg.matrix_power(R, n) @ v0 for n in cycles.ravel()]).reshape(cycles.shape +
+                                                                                                 v0.shape)
+        return powers
+    c = np.linalg.solve(V, v0.astype(complex))
+    nonzero = np.abs(w) > np.finfo(float).eps * len(w) * max(np.abs(w).max(), 1)
+    log_w, c, V = np.log(w[nonzero].astype(complex)), c[nonzero], V[:, nonzero]
+
+    def powers(cycles):
+        cycles = np.asarray(cycles, dtype=int)
+        y = np.real((np.exp(cycles[..., np.newaxis] * log_w) * c) @ V.T)
+        y[cycles == 0] = v0
+        return y
+    return powers
+
+
+def matrix_powers(R, v0, cycles):  # R^n @ v0 for every n in [cycles], see power_function
+    return power_function(R, v0)(cycles)
+
+
+def cycle_populations(n_cycles, config=spec.default_config, v0=v_ring, lost=lost_states, **kwargs):
+    # the ground state populations after 0, 1, ..., n_cycles passes, shape (n_cycles + 1, 8)
+    return matrix_powers(ring_matrix(config, lost, **kwargs), v0, np.arange(n_cycles + 1))
+
+
+def half_life(config=spec.default_config, v0=v_ring, lost=lost_states, max_cycles=2 ** 40, **kwargs):
+    # the number of passes until half the atoms are lost. finds the first pass n where the atoms left are <= half
+    # (doubling, then bisection), and interpolates the fraction of a pass assuming the atoms left decrease
+    # exponentially between passes n - 1 and n. with only |2, 2) kept and decay=False this is the same as
+    # log(1/2) / log(p/100) in OP_graph_model. returns inf if the atoms are never lost
+    powers = power_function(ring_matrix(config, lost, **kwargs), v0)
+    half = np.sum(v0) / 2
+
+    def left(n):  # the atoms left after n passes
+        return np.sum(powers(n))
+
+    high = 1
+    while left(high) > half:
+        if high >= max_cycles:
+            return np.inf
+        high = high * 2
+    low = high // 2  # left(low) > half, or low is 0
+    while high - low > 1:
+        middle = (low + high) // 2
+        if left(middle) > half:
+            low = middle
+        else:
+            high = middle
+    before, after = left(low), left(high)
+    if after <= 0:  # every atom is gone at pass high, there is nothing to interpolate
+        return float(high)
+    return low + np.log(before / half) / np.log(before / after)
+
+
+def asymptotic_half_life(config=spec.default_config, lost=lost_states, **kwargs):
+    # the half life of the slowest decaying combination of states, log(1/2) / log(|w_max|), which every start
+    # approaches after many passes
+    w = np.max(np.abs(np.linalg.eigvals(ring_matrix(config, lost, **kwargs))))
+    with np.errstate(divide='ignore'):
+        return np.log(1 / 2) / np.log(w) if w < 1 else np.inf
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    populations = cycle_populations(2000)
+    for q in range(registry.n_ground):
+        if ground_labels[q] not in lost_states:
+            plt.plot(populations[:, q], label=ground_labels[q])
+    plt.plot(populations.sum(axis=1), label='total')
+    plt.title('Percent of atoms in the ring vs number of cycles')
+    plt.xlabel('Cycles')
+    plt.ylabel('Percent')
+    plt.legend()
+    plt.show()
+    print('number of cycles until half atoms lost, only counting |2, 2): ',
+          half_life(lost=[state for state in ground_labels if state != '|2, 2)'], decay=False))
+    print('number of cycles until half atoms lost, keeping |2, 1) and |2, 2): ', half_life())
+    print('asymptotic number of cycles until half atoms lost: ', asymptotic_half_life())
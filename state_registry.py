@@ -0,0 +1,103 @@
+import re
+from fractions import Fraction
+import numpy as np
+import state_data
+
+# state_data keeps the states and transitions in nested dictionaries keyed by labels like '|2,-1)', which is easy to
+# read and write. this module compiles those dictionaries once into arrays: every state gets an integer index, and
+# every transition is a row of a sparse (COO) list with the ground index, excited index, frequency, change in m_F and
+# relative strength. the rest of the code can then use array indexing instead of going through the dictionaries and
+# slicing the labels to get the quantum numbers
+
+label_pattern = re.compile(r'^(e?)\|\s*(-?\d+(?:/\d+)?),\s*(-?\d+(?:/\d+)?)\)$')
+
+
+def parse_label(label):  # '|2,-1)' -> (False, 2.0, -1.0), 'e|1, 0)' -> (True, 1.0, 0.0), also works with 3/2
+    match = label_pattern.match(label)
+    if match is None:
+        raise ValueError('cannot read the quantum numbers of the state ' + repr(label))
+    return match.group(1) == 'e', float(Fraction(match.group(2))), float(Fraction(match.group(3)))
+
+
+class StateRegistry:
+    def __init__(self, energy_g, energy_e, allowed_transitions, emit_str, abs_str=None):
+        # the arguments have the same format as in state_data. if abs_str is not given, it is emit_str flipped around
+        if abs_str is None:
+            abs_str = {g_state: {} for g_state in allowed_transitions}
+            for e_state, g_dict in emit_str.items():
+                for g_state, strength in g_dict.items():
+                    abs_str.setdefault(g_state, {})[e_state] = strength
+
+        self.labels = list(energy_g) + list(energy_e)  # ground states first, then excited states
+        self.index = {state: i for i, state in enumerate(self.labels)}
+        self.n_states = len(self.labels)
+        self.n_ground = len(energy_g)
+        self.ground = np.arange(self.n_ground)
+        self.excited = np.arange(self.n_ground, self.n_states)
+
+        quantum_numbers = np.array([parse_label(state)[1:] for state in self.labels]).reshape(-1, 2)
+        self.F = quantum_numbers[:, 0]
+        self.m_F = quantum_numbers[:, 1]
+        self.is_excited = np.arange(self.n_states) >= self.n_ground
+        # MHz, ground relative to B = 0 F_g = 1, excited relative to B = 0 F_e = 2
+        self.energies = np.array([energy_g[state] for state in energy_g] + [energy_e[state] for state in energy_e],
+                                 dtype=float)
+
+        # the absorption transitions, in the same order as the dictionary allowed_transitions
+        self.transitions = [(g_state, e_state) for g_state, e_dict in allowed_transitions.items()
+                            for e_state in e_dict]
+        self.transition_index = {pair: i for i, pair in enumerate(self.transitions)}
+        self.t_ground = np.array([self.index[g_state] for g_state, e_state in self.transitions], dtype=int)
+        self.t_excited = np.array([self.index[e_state] for g_state, e_state in self.transitions], dtype=int)
+        # MHz, like beam_spectrum.delta_freq
+        self.t_freq = self.energies[self.t_excited] - self.energies[self.t_ground]
+        self.t_dm = self.m_F[self.t_excited] - self.m_F[self.t_ground]  # change in m_F when absorbing
+        self.t_strength = np.array([abs_str[g_state][e_state] for g_state, e_state in self.transitions], dtype=float)
+
+        # the polarization each transition needs
+        self.sigma_plus = self.t_dm > 0
+        self.pi = self.t_dm == 0
+        self.sigma_minus = self.t_dm < 0
+
+        # the spontaneous emission transitions, in the order of the dictionary emit_str
+        emissions = [(e_state, g_state) for e_state, g_dict in emit_str.items() for g_state in g_dict]
+        self.e_excited = np.array([self.index[e_state] for e_state, g_state in emissions], dtype=int)
+        self.e_ground = np.array([self.index[g_state] for e_state, g_state in emissions], dtype=int)
+        self.e_strength = np.array([emit_str[e_state][g_state] for e_state, g_state in emissions], dtype=float)
+
+    def polarization_weights(self, polar_frac):
+        # the fraction of the laser in the right polarization for each transition: polar_frac for +sigma, and the rest
+        # is split evenly between -sigma and pi. pi transitions also have half the cross section
+        weights = np.where(self.sigma_plus, polar_frac, (1 - polar_frac) / 2)
+        return np.where(self.pi, weights / 2, weights)
+
+    def absorption_matrix(self, rates):
+        # the generator M (dv/dt = M @ v) for absorption with the rate of each transition in [rates], in the order of
+        # [transitions]. [rates] can also be a stack of rate vectors (shape (..., n_transitions))
+        rates = np.asarray(rates, dtype=float)
+        M = np.zeros(rates.shape[:-1] + (self.n_states, self.n_states))
+        np.add.at(M, (..., self.t_ground, self.t_ground), -rates)
+        np.add.at(M, (..., self.t_excited, self.t_ground), rates)
+        return M
+
+    def emission_matrix(self, A21):  # the generator M for spontaneous emission
+        M = np.zeros((self.n_states, self.n_states))
+        np.add.at(M, (self.e_excited, self.e_excited), -A21 * self.e_strength)
+        np.add.at(M, (self.e_ground, self.e_excited), A21 * self.e_strength)
+        return M
+
+    def sparse_generator(self, rates, A21):
+        # the whole generator (absorption with [rates] in the order of [transitions], plus spontaneous emission) as a
+        # scipy.sparse CSR matrix, built straight from the transition lists, so it only costs as much as the number
+        # of transitions. entries for the same place are added up
+        from scipy.sparse import coo_matrix
+        rates = np.asarray(rates, dtype=float)
+        emission = A21 * self.e_strength
+        rows = np.concatenate([self.t_ground, self.t_excited, self.e_excited, self.e_ground])
+        columns = np.concatenate([self.t_ground, self.t_ground, self.e_excited, self.e_excited])
+        values = np.concatenate([-rates, rates, -emission, emission])
+        return coo_matrix((values, (rows, columns)), shape=(self.n_states, self.n_states)).tocsr()
+
+
+registry = StateRegistry(state_data.energy_g, state_data.energy_e, state_data.allowed_transitions,
+                         state_data.emit_str, state_data.abs_str)  # the Li 7 states in state_data
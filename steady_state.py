@@ -0,0 +1,118 @@
+import warnings
+import numpy as np
+import beam_spectrum as spec
+import OP_graph_model as model
+from state_registry import registry
+
+# for tuning the laser we mostly want to know where the pumping ends up and how fast it gets there, not the whole
+# trajectory. the rate equations dv/dt = M @ v have the solution sum_i c_i exp(w_i t) V_i (w, V the eigenvalues and
+# eigenvectors of the generator M), so
+#     - the populations at long times are the stationary distribution, M @ v = 0 (the eigenvalue w = 0). M always has
+#       a 0 eigenvalue because no atoms are created or lost (the columns of M add up to 0). if the stationary state is
+#       unique it does not depend on v0 and is found with one sparse solve, replacing one of the equations by
+#       sum(v) = total. if it is not unique (e.g. a state the laser never reaches) it is the part of v0 along the
+#       eigenvectors with w = 0
+#     - the other eigenvalues have negative real parts, and -Re(w) are the relaxation rates. the smallest one sets the
+#       slowest pumping time constant
+#     - the pumping time is the first time the population of the pumped state reaches a target
+# all of these need one 16x16 factorization, so they are cheap enough to use for every step of an optimizer
+
+pumped_state = '|2, 2)'
+
+
+def sparse_generator(M):  # the generator as a scipy.sparse CSR matrix (most of its entries are 0)
+    from scipy.sparse import csr_matrix
+    return csr_matrix(np.asarray(M, dtype=float))
+
+
+def stationary(M, v0=model.v_input, total=None):
+    # the populations at t -> infinity. total is the number of atoms (sum(v0) if None, i.e. 100 for percent)
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.linalg import MatrixRankWarning, spsolve
+    v0 = np.asarray(v0, dtype=float)
+    total = np.sum(v0) if total is None else total
+    A = sparse_generator(M).tolil()
+    A[0, :] = 1  # the first equation is replaced by sum(v) = total
+    b = np.zeros(A.shape[0])
+    b[0] = total
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', MatrixRankWarning)
+        try:
+            v = spsolve(csr_matrix(A), b)
+        except (MatrixRankWarning, RuntimeError):  # more than one stationary state
+            v = None
+    if v is not None and np.all(np.isfinite(v)) and np.allclose(M @ v, 0, atol=10 ** -9 * np.abs(M).max() * total):
+        return v
+    # the long time limit of expm(M t) @ v0 keeps the parts of v0 along the eigenvectors with w = 0
+    w, V = np.linalg.eig(M)
+    zero = np.abs(w) <= 10 ** -9 * np.abs(w).max()
+    c = np.linalg.lstsq(V, v0, rcond=None)[0]
+    return np.real(V[:, zero] @ c[zero]) * total / np.sum(v0)
+
+
+def relaxation_rates(M, n=3):
+    # the [n] smallest relaxation rates (1/s), -Re(w) of the eigenvalues of M that are not 0, smallest first. the
+    # slowest time constant of the pumping is 1 / relaxation_rates(M)[0]
+    w = np.linalg.eigvals(np.asarray(M, dtype=float))
+    rates = np.sort(-w.real[np.abs(w) > 10 ** -9 * np.abs(w).max()])
+    return rates[:n]
+
+
+def _population(M, v0, i):
+    # returns a function of an array of times that gives the population of state i, like OP_graph_model.propagate
+    # but with the eigendecomposition done only once
+    w, V = np.linalg.eig(M)
+    if np.linalg.cond(V, 1) >= 10 ** 8:
+        def population(times):  # times can also be one time (from brentq)
+            times = np.asarray(times, dtype=float)
+            return model.propagate(M, v0, np.atleast_1d(times), 'expm')[i].reshape(times.shape)
+        return population
+    a = V[i] * np.linalg.solve(V, v0.astype(complex))
+    return lambda times: np.real(np.exp(np.multiply.outer(times, w)) @ a)
+
+
+def pumping_time(M, target, v0=model.v_input, state=pumped_state, t_max=None):
+    # the first time (s) the population of [state] reaches [target] (percent, like v0), starting from v0. returns inf
+    # if it never does. the population is checked on a grid of times out to t_max (20 times the slowest time
+    # constant if None), and the crossing is found with brentq
+    from scipy.optimize import brentq
+    i = registry.index[state]
+    v0 = np.asarray(v0, dtype=float)
+    if v0[i] >= target:
+        return 0.0
+    if t_max is None:
+        slowest = relaxation_rates(M, 1)
+        if len(slowest) == 0 or slowest[0] <= 0:
+            return np.inf
+        t_max = 20 / slowest[0]
+    times = np.concatenate([[0], np.geomspace(t_max * 10 ** -9, t_max, 512)])
+    population = _population(M, v0, i)
+    above = np.nonzero(population(times) >= target)[0]
+    if len(above) == 0:
+        return np.inf
+    k = above[0]
+    return brentq(lambda t: population(t) - target, times[k - 1], times[k], xtol=10 ** -15, rtol=10 ** -12)
+
+
+def analyze(config=spec.default_config, target=99, v0=model.v_input, state=pumped_state):
+    # the long time behaviour of the pumping for the laser settings in config. returns a result with
+    #     .stationary         the populations (percent) at long times
+    #     .fidelity           the percent in [state] at long times
+    #     .relaxation_rates   the 3 slowest relaxation rates (1/s)
+    #     .time_constant      the slowest time constant (s)
+    #     .pumping_time       the time (s) until [target] percent are in [state] (inf if it never happens)
+    from scipy.optimize import OptimizeResult
+    M = model._generator(config)
+    v = stationary(M, v0)
+    rates = relaxation_rates(M)
+    return OptimizeResult(stationary=v, fidelity=v[registry.index[state]], relaxation_rates=rates,
+                          time_constant=1 / rates[0] if len(rates) and rates[0] > 0 else np.inf,
+                          pumping_time=pumping_time(M, target, v0, state))
+
+
+if __name__ == '__main__':
+    result = analyze()
+    print('percent in |2, 2) at long times: ', result.fidelity)
+    print('slowest pumping time constant (s): ', result.time_constant)
+    print('time until 99 percent are in |2, 2) (s): ', result.pumping_time)
+    print('percent in |2, 2) after 1 cm of pumping: ', model.solve_pumping()[0].y[4, -1])
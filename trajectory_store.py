@@ -0,0 +1,186 @@
+import json
+import os
+import numpy as np
+import beam_spectrum as spec
+import OP_graph_model as model
+from state_registry import registry
+
+# the populations of long runs (many configs, many initial states, many time steps) do not have to fit in memory.
+# a store is a directory with
+#     populations.npy   the populations, shape (batch..., 16, n_times), e.g. (n_configs, n_initial, 16, n_times)
+#     times.npy         the times (s) of the last axis
+#     metadata.json     the state labels (the order of the 16 axis), the shape, and the parameters of each run
+# the .npy files are written chunk by chunk through a memory map (np.lib.format.open_memmap), so only one chunk is
+# in memory at a time, and they are read back with np.load(mmap_mode='r'), so slicing them only reads the part that
+# is used and does not copy it. the files are plain .npy, so they can also be opened without this module
+
+populations_file = 'populations.npy'
+times_file = 'times.npy'
+metadata_file = 'metadata.json'
+
+
+def _parameters(parameters):  # LaserConfigs are saved as dictionaries so the json can be read without this code
+    if isinstance(parameters, spec.LaserConfig):
+        return parameters._asdict()
+    if isinstance(parameters, (list, tuple)):
+        return [_parameters(i) for i in parameters]
+    return parameters
+
+
+class TrajectoryWriter:
+    def __init__(self, directory, batch, times, labels=registry.labels, parameters=None, dtype=float):
+        # makes a new store in directory for populations of shape batch + (len(labels), len(times)). the file is made
+        # at its full size at once (on most file systems only the parts written take up disk space)
+        self.directory = directory
+        self.times = np.asarray(times, dtype=float)
+        self.shape = tuple(batch) + (len(labels), len(self.times))
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, times_file), self.times)
+        self.populations = np.lib.format.open_memmap(os.path.join(directory, populations_file), mode='w+',
+                                                     dtype=dtype, shape=self.shape)
+        self.metadata = {'labels': list(labels), 'shape': list(self.shape), 'dtype': np.dtype(dtype).str,
+                         'parameters': _parameters(parameters), 'complete': False}
+        self._write_metadata()
+
+    def write(self, index, y, start=0):
+        # writes populations y (shape (..., 16, n)) into the trajectories at [index] (an int, a tuple or a slice of
+        # the batch axes) for the times start to start + n
+        y = np.asarray(y)
+        index = index if isinstance(index, tuple) else (index,)
+        self.populations[index + (Ellipsis, slice(start, start + y.shape[-1]))] = y
+
+    def write_rows(self, first, y, start=0):
+        # writes populations y (shape (k, 16, n)) for the trajectories first to first + k of the flattened batch (the
+        # batch axes in C order, like np.ravel) for the times start to start + n
+        rows = self.populations.reshape((-1,) + self.shape[-2:])
+        rows[first:first + len(y), :, start:start + y.shape[-1]] = y
+
+    def flush(self):
+        self.populations.flush()
+
+    def close(self):  # writes everything to disk and marks the store as complete
+        if self.populations is None:
+            return
+        self.flush()
+        self.populations = None  # drops the memory map, which closes the file
+        self.metadata['complete'] = True
+        self._write_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:  # keep what was written, but do not mark it as complete
+            self.flush()
+            self.populations = None
+
+    def _write_metadata(self):
+        path = os.path.join(self.directory, metadata_file)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.metadata, file, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+class TrajectoryStore:
+    def __init__(self, directory):
+        # opens a store for reading. .populations and .times are read-only memory maps, so
+        # store.populations[3, 0, 4, ::100] only reads those values from disk
+        self.directory = directory
+        with open(os.path.join(directory, metadata_file)) as file:
+            self.metadata = json.load(file)
+        self.labels = self.metadata['labels']
+        self.index = {state: i for i, state in enumerate(self.labels)}
+        self.parameters = self.metadata['parameters']
+        self.complete = self.metadata['complete']
+        self.populations = np.load(os.path.join(directory, populations_file), mmap_mode='r')
+        self.times = np.load(os.path.join(directory, times_file), mmap_mode='r')
+
+    def state(self, label):  # the populations of one state, shape (batch..., n_times), a view of the file
+        return self.populations[..., self.index[label], :]
+
+    def final(self):  # the populations at the last time, shape (batch..., 16), the only part read from disk
+        return self.populations[..., -1]
+
+
+def open_store(directory):
+    return TrajectoryStore(directory)
+
+
+def _stream(writer, block, n_rows, times, chunk, method, rows):
+    # fills writer with n_rows trajectories (the flattened batch), [rows] trajectories and [chunk] times at a time.
+    # block(a, b) returns the generators and initial populations of the trajectories a to b, so only one block of
+    # them is in memory. with 'eig' each block is factorized once (OP_graph_model.eig_solution) and every chunk of
+    # times comes from the same factorization. the trajectories it is not accurate for, and everything with 'expm',
+    # step from one time to the next, so each chunk starts where the last one stopped
+    for a in range(0, n_rows, rows):
+        M, v0 = block(a, min(a + rows, n_rows))
+        if method == 'eig':
+            w, V, c, bad = model.eig_solution(M, v0)
+        else:
+            bad = np.ones(len(v0), dtype=bool)
+        M_bad = M[bad]
+        v = v0[bad]
+        t0 = 0
+        for start in range(0, len(times), chunk):
+            t = times[start:start + chunk]
+            if not np.any(bad):
+                y = model.eig_populations(w, V, c, t)
+            else:
+                y = np.empty(v0.shape + t.shape)
+                if method == 'eig':
+                    y[~bad] = model.eig_populations(w[~bad], V[~bad], c[~bad], t)
+                y[bad] = model.propagate(M_bad, v, t - t0, 'expm')
+                v = y[bad][..., -1]
+                t0 = t[-1]
+            writer.write_rows(a, y, start)
+
+
+def _rows(n_states, n_times, chunk, block_bytes):
+    # the number of trajectories in a block, so the arrays of one chunk (the complex ones of eig_populations included,
+    # about 40 bytes per value) take about block_bytes
+    return max(1, int(block_bytes // (40 * n_states * min(chunk, max(n_times, 1)))))
+
+
+def stream(directory, M, v0s, times, chunk=4096, method='eig', parameters=None, block_bytes=2 ** 27):
+    # solves dv/dt = M @ v like OP_graph_model.propagate (M and v0s are broadcast against each other in the same way)
+    # and writes the populations to a store in directory, [chunk] times and about block_bytes of trajectories at a
+    # time, so neither the batch nor the times have to fit in memory. the result is the same as one big propagate
+    # call. returns the directory
+    M = np.asarray(M, dtype=float)
+    v0s = np.asarray(v0s, dtype=float)
+    times = np.asarray(times, dtype=float)
+    batch = np.broadcast_shapes(M.shape[:-2], v0s.shape[:-1])
+    M_all = np.broadcast_to(M, (batch or (1,)) + M.shape[-2:])  # views, nothing is copied
+    v0_all = np.broadcast_to(v0s, (batch or (1,)) + v0s.shape[-1:])
+
+    def block(a, b):
+        index = np.unravel_index(np.arange(a, b), batch or (1,))
+        return M_all[index], v0_all[index]
+
+    with TrajectoryWriter(directory, batch, times, parameters=parameters) as writer:
+        _stream(writer, block, int(np.prod(batch)), times, chunk, method,
+                _rows(M.shape[-1], len(times), chunk, block_bytes))
+    return directory
+
+
+def stream_batch(directory, configs, v0s=model.ground_starts, times=model.t_eval, chunk=4096, method='eig',
+                 block_bytes=2 ** 27):
+    # like OP_graph_model.solve_batch, but writes the (len(configs), n_initial, 16, len(times)) populations to a
+    # store instead of returning them. the generators are made block by block, and the configs are saved in the
+    # metadata
+    configs = list(configs)
+    v0s = np.atleast_2d(np.asarray(v0s, dtype=float))
+    times = np.asarray(times, dtype=float)
+    n_initial = len(v0s)
+
+    def block(a, b):
+        index = np.arange(a, b)
+        generators = {i: model.generator(configs[i]) for i in set(index // n_initial)}
+        return np.stack([generators[i] for i in index // n_initial]), v0s[index % n_initial]
+
+    with TrajectoryWriter(directory, (len(configs), n_initial), times, parameters=configs) as writer:
+        _stream(writer, block, len(configs) * n_initial, times, chunk, method,
+                _rows(v0s.shape[-1], len(times), chunk, block_bytes))
+    return directory
@@ -0,0 +1,98 @@
+import math
+import numpy as np
+import beam_spectrum as spec
+import OP_graph_model as model
+from state_registry import registry
+from scipy.optimize import OptimizeResult
+
+# OP_graph_model treats the 1 cm of optical pumping as a uniform rate for 50 us, which is right for a uniform beam and
+# atoms at 20000 cm/s. in this module the atoms fly through the beam instead: the laser intensity changes along the
+# beam (z, in cm) following a profile, and the atoms have a distribution of velocities.
+# the rates from beam_spectrum are the average rates of the uniform beam. I scale the absorption rates with the
+# profile, envelope(z), which is normalized so its average over the beam is 1 (the same number of photons as the
+# uniform beam). so at position z the generator is envelope(z) * A + E, where A is the absorption part and E the
+# spontaneous emission part. this does not redo the A21 saturation for the higher intensity in the middle of the beam.
+# the beam is split into segments with a constant envelope (its value in the middle of the segment). in a segment an
+# atom with velocity v spends dz / v, and the populations change by exactly expm((envelope * A + E) * dz / v). the
+# eigendecomposition of each segment's generator does not depend on v, so it is done once for all velocity classes
+
+length = 1  # cm, the length of the optical pumping region
+speed = 20000  # cm/s, the speed of the atoms in the uniform model
+
+
+def uniform_profile(z):  # the uniform beam of OP_graph_model
+    return np.ones_like(np.asarray(z, dtype=float))
+
+
+def gaussian_profile(waist, center=None, length=length):
+    # returns the intensity profile exp(-2 (z - center)**2 / waist**2) of a Gaussian beam with 1/e**2 radius waist
+    # (cm), normalized so its average over the region from 0 to length is 1. the beam is in the middle of the region
+    # (length / 2) if center is None
+    if center is None:
+        center = length / 2
+    total = waist * math.sqrt(math.pi / 8) * (math.erf(math.sqrt(2) * (length - center) / waist) +
+                                              math.erf(math.sqrt(2) * center / waist))
+
+    def profile(z):
+        return np.exp(-2 * (np.asarray(z, dtype=float) - center) ** 2 / waist ** 2) * length / total
+    return profile
+
+
+def gaussian_velocities(mean=speed, spread=2000, n=16):
+    # velocity classes (cm/s) and their weights for a Gaussian distribution with standard deviation spread, using
+    # Gauss-Hermite quadrature so a few classes give accurate averages. classes with v <= 0 are dropped
+    nodes, weights = np.polynomial.hermite_e.hermegauss(n)
+    velocities = mean + spread * nodes
+    keep = velocities > 0
+    return velocities[keep], weights[keep] / np.sum(weights[keep])
+
+
+def transit(config=spec.default_config, profile=uniform_profile, velocities=(speed,), weights=None,
+            v0=model.v_input, n_segments=200, length=length):
+    # flies the atoms starting with populations v0 through the beam, one velocity class per entry of velocities (cm/s)
+    # weights are the fraction of atoms in each class (equal if None). returns a result with
+    #     .z         the positions (cm) where the populations are saved, the edges of the segments
+    #     .y         the populations of every class at every position, shape (len(velocities), 16, len(z))
+    #     .average   the weighted average over the classes, shape (16, len(z))
+    velocities = np.asarray(velocities, dtype=float)
+    weights = np.full(len(velocities), 1 / len(velocities)) if weights is None else np.asarray(weights, dtype=float)
+    A = registry.absorption_matrix(spec.rate_table(config) * 20000)
+    E = model.emission_matrix()
+
+    z = np.linspace(0, length, n_segments + 1)
+    dz = np.diff(z)
+    envelope = profile((z[1:] + z[:-1]) / 2)
+    w, V = np.linalg.eig(envelope[:, np.newaxis, np.newaxis] * A + E)  # one generator per segment
+    bad = np.linalg.cond(V, 1) >= 10 ** 8
+    V = np.where(bad[:, np.newaxis, np.newaxis], np.eye(len(A)), V)
+    V_inv = np.linalg.inv(V)
+
+    y = np.empty((len(velocities), len(A), len(z)))
+    y[:, :, 0] = v0
+    for k in range(n_segments):
+        dt = dz[k] / velocities  # the time each class spends in the segment
+        if bad[k]:  # the eigenvectors are not accurate enough, use expm for this segment
+            from scipy.linalg import expm
+            step = expm((envelope[k] * A + E) * dt[:, np.newaxis, np.newaxis])
+            y[:, :, k + 1] = (step @ y[:, :, k, np.newaxis])[..., 0]
+        else:
+            c = (y[:, :, k] @ V_inv[k].T) * np.exp(np.outer(dt, w[k]))
+            y[:, :, k + 1] = np.real(c @ V[k].T)
+    return OptimizeResult(z=z, y=y, velocities=velocities, weights=weights,
+                          average=np.tensordot(weights, y, axes=1), envelope=envelope)
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    classes, fractions = gaussian_velocities()
+    uniform = transit()
+    gaussian = transit(profile=gaussian_profile(0.3), velocities=classes, weights=fractions)
+    plt.plot(uniform.z, uniform.average[4], label='uniform beam, 20000 cm/s')
+    plt.plot(gaussian.z, gaussian.average[4], label='Gaussian beam (w = 3 mm), velocity spread')
+    plt.title('Percent of atoms in |2, 2) vs position in the beam')
+    plt.xlabel('Position (cm)')
+    plt.ylabel('Percent')
+    plt.legend()
+    plt.show()
+    print('percent in |2, 2) after the uniform beam: ', uniform.average[4, -1])
+    print('percent in |2, 2) after the Gaussian beam with a velocity spread: ', gaussian.average[4, -1])